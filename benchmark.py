@@ -0,0 +1,238 @@
+# This is the benchmark suite of the parser and the automata
+# It runs a fixed corpus of patterns and some families of patterns that grow with a number,
+# and writes the time and memory of every measurement as json, so that two runs can be compared
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json
+#   python benchmark.py --compare before.json after.json
+#
+# The same file runs on the older trees too, where some measurements take very long, so every
+# measurement is stopped after --timeout seconds and recorded as timed out
+
+from regexp import RegexpParser
+from dfa import combine_DFA
+from nfa import concat_NFA, kleene_NFA
+import argparse
+import inspect
+import json
+import platform
+import random
+import signal
+import statistics
+import sys
+import time
+import tracemalloc
+
+# The fixed corpus, with the feature of the grammar each pattern stresses
+CORPUS = [
+    ('literal', 'abcdefgh'),
+    ('char_class', '\\a*@\\a(\\a|\\0)*'),
+    ('char_class_digits', '\\1\\0*(\\.\\0^[1-2])'),
+    ('nesting', '((((a|b)c)*d)*(e|f))*'),
+    ('deep_nesting', '(((((((a)*b)*a)*b)*a)*b)*a)*'),
+    ('repetition', '(ab|c)^[2-6]'),
+    ('repetition_wide', '(a|b)^[3-9]c'),
+    ('negation', '~((a|b)*abb(a|b)*)'),
+    ('double_negation', '~(~(a*b*)|ab)'),
+    ('intersection', '(a|b)*a(a|b)*&(a|b)*b(a|b)*'),
+    ('difference', '(a|b|c)*-(a|b)*c(a|b|c)*'),
+    ('product_chain', '(a|b)*aa(a|b)*&~((a|b)*bb(a|b)*)&(a|b)^[4-8]'),
+]
+
+# The families of patterns that grow with n, and the largest n that is run by default
+FAMILIES = [
+    ('nth_from_end', lambda n : '(a|b)*a(a|b)^'+str(n), 10),
+    ('negated_nth_from_end', lambda n : '~((a|b)*a(a|b)^'+str(n)+')', 8),
+    ('repetition_range', lambda n : '(ab|c)^[1-'+str(n)+']', 24),
+    ('nesting_depth', lambda n : '('*n+'a'+''.join(')*' if i%2 == 0 else 'b)*' for i in range(n)), 24),
+    ('intersections', lambda n : '&'.join('(a|b)*'+'ab'[i%2]*(i//2+1)+'(a|b)*' for i in range(n)), 8),
+]
+
+class Timeout(Exception):
+    pass
+
+def stop(signum, frame):
+    raise Timeout()
+
+def measure(function, repeat, memory, timeout = None):
+    # Times the function a number of times, and finds its peak memory with one more run
+    # The memory is measured separately, because tracing the memory slows everything down
+    # With a timeout, all the runs together are stopped after that many seconds (where the
+    # platform has interval timers), and only the timeout is recorded
+    if timeout and hasattr(signal,'setitimer'):
+        handler = signal.signal(signal.SIGALRM,stop)
+        signal.setitimer(signal.ITIMER_REAL,timeout)
+        try:
+            return measure(function,repeat,memory)
+        except Timeout:
+            return {'repeat':repeat, 'timeout':timeout}
+        finally:
+            signal.setitimer(signal.ITIMER_REAL,0)
+            signal.signal(signal.SIGALRM,handler)
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    result = {'repeat':repeat, 'time_min':min(times), 'time_median':statistics.median(times)}
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+def parse(pattern):
+    # Parses with a new parser every time, so nothing is remembered from the previous runs
+    # Only the methods of the first version of the parser and the automata are used, or the
+    # newer ones where they are found, so that the suite also runs on the older trees
+    return RegexpParser().parse_string(pattern)
+
+def takes(function, name):
+    # Checks if a function has a parameter of the given name
+    return name in inspect.signature(function).parameters
+
+def extract_dfa(nfa, alphabet):
+    # The older nfa's find the alphabet of the dfa by themselves
+    if takes(nfa.extract_dfa,'alphabet'):
+        return nfa.extract_dfa(alphabet)
+    return nfa.extract_dfa()
+
+def benchmark_pattern(pattern, repeat, memory, strings, timeout = None):
+    # Runs all the measurements for a single pattern, and returns their records
+    records = []
+    dfa = parse(pattern)
+    info = {'pattern':pattern, 'states':dfa.num_states, 'alphabet':len(dfa.alphabet)}
+
+    def record(name, function):
+        records.append(dict(info,benchmark=name,**measure(function,repeat,memory,timeout)))
+
+    record('parse_string',lambda : parse(pattern))
+
+    # The product with a fixed language over the same alphabet
+    other = parse('('+'|'.join(dfa.alphabet)+')*'+dfa.alphabet[0])
+    record('combine_DFA',lambda : combine_DFA(dfa,other,'&'))
+
+    # The subset construction, on the nfa of the kleene star and of a concatenation
+    star = kleene_NFA(dfa.extract_nfa())
+    record('extract_dfa_kleene',lambda : extract_dfa(star,dfa.alphabet))
+    concat = concat_NFA(dfa.extract_nfa(),other.extract_nfa())
+    record('extract_dfa_concat',lambda : extract_dfa(concat,dfa.alphabet))
+
+    def dead_states():
+        dfa.computed_dead_states = False
+        dfa.compute_dead_states()
+    record('compute_dead_states',dead_states)
+
+    def next_strings():
+        dfa.get_next_string(True)
+        for i in range(strings-1):
+            dfa.get_next_string()
+    record('get_next_string',next_strings)
+
+    # Random strings of a fixed length, the tables are made by the first run
+    # The older generate only uses the random module, so that is seeded instead
+    def generate():
+        if takes(dfa.generate,'rng'):
+            rng = random.Random(0)
+            for i in range(strings):
+                dfa.generate(16,rng)
+        else:
+            random.seed(0)
+            for i in range(strings):
+                dfa.generate(16)
+    record('generate',generate)
+
+    # Matching random strings over the alphabet, one by one, in a batch and with the
+    # generated matcher. The matcher is generated before it is timed
+    rng = random.Random(0)
+    texts = [''.join(rng.choice(dfa.alphabet) for i in range(64)) for j in range(strings)]
+    def check_string():
+        for text in texts:
+            dfa.check_string(text)
+    record('check_string',check_string)
+    if hasattr(dfa,'check_strings'):
+        record('check_strings',lambda : dfa.check_strings(texts))
+    if hasattr(dfa,'compile_to_python'):
+        match = dfa.compile_to_python()
+        def compiled():
+            for text in texts:
+                match(text)
+        record('compile_to_python',compiled)
+    return records
+
+def run(repeat=5, memory=True, strings=100, scale=1.0, families=True, timeout=60):
+    # Runs the whole suite and returns the results
+    results = []
+    for name, pattern in CORPUS:
+        for record in benchmark_pattern(pattern,repeat,memory,strings,timeout):
+            results.append(dict(record,case=name))
+    if families:
+        for name, make, top in FAMILIES:
+            for n in range(1,max(1,int(top*scale))+1):
+                for record in benchmark_pattern(make(n),repeat,memory,strings,timeout):
+                    results.append(dict(record,case=name,n=n))
+    meta = {
+        'python':platform.python_version(),
+        'implementation':platform.python_implementation(),
+        'machine':platform.machine(),
+        'repeat':repeat,
+        'strings':strings,
+        'scale':scale,
+        'timeout':timeout,
+        'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    return {'meta':meta, 'results':results}
+
+def compare(before, after):
+    # Prints the ratio of the times of two runs, for the measurements that are in both
+    # The measurements that timed out are shown as the timeout, with no ratio
+    def key(record):
+        return (record['benchmark'],record['case'],record.get('n'))
+    old = {key(record):record for record in before['results']}
+    print("%-20s %-24s %4s %12s %12s %8s" % ('benchmark','case','n','before','after','ratio'))
+    for record in after['results']:
+        if key(record) not in old:
+            continue
+        n = record.get('n')
+        t0 = old[key(record)].get('time_min')
+        t1 = record.get('time_min')
+        if t0 is None or t1 is None:
+            t0 = '>%gs' % old[key(record)]['timeout'] if t0 is None else '%.6f' % t0
+            t1 = '>%gs' % record['timeout'] if t1 is None else '%.6f' % t1
+            print("%-20s %-24s %4s %12s %12s %8s" % (record['benchmark'],record['case'],'' if n is None else n,t0,t1,''))
+            continue
+        print("%-20s %-24s %4s %12.6f %12.6f %8.2f" % (record['benchmark'],record['case'],'' if n is None else n,t0,t1,t1/t0 if t0 > 0 else float('inf')))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the regular expression parser and the automata")
+    parser.add_argument('--output', help="the json file of the results, they are printed if it is not given")
+    parser.add_argument('--repeat', type=int, default=5, help="how many times every measurement is repeated")
+    parser.add_argument('--strings', type=int, default=100, help="how many strings are enumerated and generated")
+    parser.add_argument('--scale', type=float, default=1.0, help="scales the largest n of the families")
+    parser.add_argument('--no-memory', action='store_true', help="skip the memory measurements")
+    parser.add_argument('--no-families', action='store_true', help="only run the fixed corpus")
+    parser.add_argument('--timeout', type=float, default=60, help="the seconds after which a measurement is stopped, 0 for no limit")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE','AFTER'), help="compare two json files of results")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before,after)
+        return
+
+    results = run(args.repeat,not args.no_memory,args.strings,args.scale,not args.no_families,args.timeout)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+    else:
+        json.dump(results,sys.stdout,indent=1)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,89 @@
 
 import random
 import math
+import bisect
+import struct
+import sys
+import re
+from array import array
 from nfa import NFA, kleene_NFA, base_NFA, concat_NFA
 
+# The binary format of a saved dfa (see DFA.to_bytes)
+# magic, version, number of states, start state, number of characters, number of columns,
+# number of edges and the size of the alphabet in bytes
+FORMAT_MAGIC = b'RLDFA'
+FORMAT_VERSION = 1
+FORMAT_HEADER = struct.Struct('<5sBIIIIQI')
+
+class TableRow:
+    # This is a read-only view of the edges of a single state in a compact dfa
+    # It behaves like the dictionary of characters the state would have otherwise
+
+    def __init__(self, dfa, state):
+        self.dfa = dfa
+        self.base = state*dfa.num_columns
+
+    def __getitem__(self, char):
+        se = self.dfa.table[self.base+self.dfa.char_index[char]]
+        if se == -1:
+            raise KeyError(char)
+        return se
+
+    def __contains__(self, char):
+        if char not in self.dfa.char_index:
+            return False
+        return self.dfa.table[self.base+self.dfa.char_index[char]] != -1
+
+    def __iter__(self):
+        for char in self.dfa.char_index:
+            if self.dfa.table[self.base+self.dfa.char_index[char]] != -1:
+                yield char
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def get(self, char, default=None):
+        return self[char] if char in self else default
+
+    def keys(self):
+        return list(iter(self))
+
+    def values(self):
+        return [self[char] for char in self]
+
+    def items(self):
+        return [(char,self[char]) for char in self]
+
+class TableEdges:
+    # This is a read-only view of all the edges of a compact dfa
+    # It behaves like the dictionary of states the dfa would have otherwise
+
+    def __init__(self, dfa):
+        self.dfa = dfa
+
+    def __getitem__(self, state):
+        if state < 0 or state >= self.dfa.num_states:
+            raise KeyError(state)
+        return TableRow(self.dfa,state)
+
+    def __contains__(self, state):
+        return 0 <= state < self.dfa.num_states
+
+    def __iter__(self):
+        return iter(range(self.dfa.num_states))
+
+    def __len__(self):
+        return self.dfa.num_states
+
+    def keys(self):
+        return list(range(self.dfa.num_states))
+
+    def values(self):
+        return [self[s] for s in range(self.dfa.num_states)]
+
+    def items(self):
+        return [(s,self[s]) for s in range(self.dfa.num_states)]
+
 class DFA:
     # This is a representation of a DFA
     
@@ -25,19 +106,31 @@ class DFA:
         self.dead_states = set() # These are found separately
         self.target_distance = {} # The minimum distance each state has from a target state
         self.target_max_length = float('inf') # The maximum distance the furthest state has from a target state
-        
+        self.counting_graph = None # The graph of the useful states, used for counting strings
+        self.sample_edges = None # The tables used to generate random strings
+        self.sample_counts = None
+        self.sample_cumulative = None
+        self.sample_ordered = None
+        self.python_source = None # The generated matcher of compile_to_python and its source
+        self.python_matcher = None
+
         # Edges are a dictionary of states, corresponding to a filled dictionary of the alphabet
         # that has the value of the next state
         # If one or more of the dictionaries is not yet filled, the DFA is invalid
         self.num_edges = 0 # Take note of number of edges to know if you are complete
         self.edges = {0:{}}
+
+        # After construction the edges can be moved to a compact table (see compact)
+        # The table is a flat array with a row for every state and a column for every character,
+        # and missing edges are marked with -1. A frozen dfa can not be altered any more
+        self.table = None
+        self.char_index = None
+        self.num_columns = len(self.alphabet)
+        self.frozen = False
+        self.buffer = None # The buffer the table is read from, if it was loaded without a copy
         
-        # Extra variables to calculate the next string on set
-        self.next_len = 0
-        self.next_in = 0
-        self.depth_list = []
-        self.backtracked = False
-        self.ab_next = { self.alphabet[i]:self.alphabet[i+1] for i in range(len(self.alphabet)-1)}
+        # The enumeration that get_next_string continues
+        self.next_strings = None
     
     def print_info(self):
         # Prints info on the DFA
@@ -60,6 +153,9 @@ class DFA:
     
     def add_state(self, target = False):
 
+        # Frozen dfa's can't change
+        self.check_mutable()
+
         # Reset the computations
         self.computed_dead_states = False
         self.computed_target_distance = False
@@ -72,8 +168,11 @@ class DFA:
         if target:
             self.target_states.add(new_state)
         
-        # Make and edge dictionary addition
-        self.edges[new_state] = {}
+        # Make and edge dictionary addition, or a new row in the table
+        if self.table is not None:
+            self.table.extend(array('i',[-1])*self.num_columns)
+        else:
+            self.edges[new_state] = {}
         
         # Finally return the state
         return new_state
@@ -81,6 +180,9 @@ class DFA:
     def add_edge(self, ss, se, char):
         # Adds a new edge to the state
         # If it exists, it will replace it
+
+        # Frozen dfa's can't change
+        self.check_mutable()
         
         # Reset the computations
         self.computed_dead_states = False
@@ -101,14 +203,220 @@ class DFA:
             self.num_edges += 1
 
         # If the checks are correct, add the edge
-        self.edges[ss][char] = se
+        # A character that shares its column needs a column of its own first
+        if self.table is not None:
+            column = self.char_index[char]
+            if self.table[ss*self.num_columns+column] != se and list(self.char_index.values()).count(column) > 1:
+                self.split_column(char)
+            self.table[ss*self.num_columns+self.char_index[char]] = se
+        else:
+            self.edges[ss][char] = se
     
+    def next_state(self,state_from, char):
+        # Returns the state the edge of the character leads to
+        if self.table is not None:
+            st = self.table[state_from*self.num_columns+self.char_index[char]]
+            if st == -1:
+                raise KeyError(char)
+            return st
+        return self.edges[state_from][char]
+
     def find_state(self,state_from, char):
-        st = self.edges[state_from][char]
+        st = self.next_state(state_from,char)
         return (st,st in self.target_states)
 
+    def check_mutable(self):
+        # Raises if the dfa is frozen and someone tries to change it
+        if self.frozen:
+            raise Exception("Tried to alter a frozen DFA")
+
+    def transition_table(self):
+        # Returns the edges as a flat table, along with the character to column map
+        # and the number of columns. Missing edges are marked with -1
+        # Characters that behave the same in every state share a column (see symbol_classes)
+        # If the dfa is compact it returns its own table, so it must not be altered
+        if self.table is not None:
+            return (self.table, self.char_index, self.num_columns)
+
+        char_index = {char:i for i,char in enumerate(self.alphabet)}
+        cols = len(self.alphabet)
+        table = array('i',[-1])*(self.num_states*cols)
+        for state in range(self.num_states):
+            base = state*cols
+            for char, se in self.edges[state].items():
+                if char in char_index:
+                    table[base+char_index[char]] = se
+        return compress_table(table,char_index,cols)
+
+    def symbol_classes(self):
+        # Returns the classes of characters that lead to the same state from every state
+        # Each class is a list of characters, in the order of the alphabet
+        table, char_index, cols = self.transition_table()
+        classes = [[] for c in range(cols)]
+        for char in char_index:
+            classes[char_index[char]].append(char)
+        return [cl for cl in classes if len(cl) != 0]
+
+    def count_edges(self):
+        # Counts the edges of a compact dfa, a column counts once for every character it has
+        table, char_index, cols = self.transition_table()
+        present = [self.num_states-list(table[c::cols]).count(-1) for c in range(cols)]
+        return sum(present[char_index[char]] for char in char_index)
+
+    def split_column(self, char):
+        # Gives the character a column of its own in the table, so that its edges
+        # can change without changing the edges of the rest of its class
+        cols = self.num_columns
+        column = self.char_index[char]
+        new_table = array('i')
+        for state in range(self.num_states):
+            base = state*cols
+            new_table.extend(self.table[base:base+cols])
+            new_table.append(self.table[base+column])
+        self.table = new_table
+        self.char_index[char] = cols
+        self.num_columns = cols+1
+
+    def set_table(self, table, num_states, char_index = None):
+        # Replaces all the states and edges of the dfa with the given table
+        # Without a character to column map, the table must have a column for every character
+        self.check_mutable()
+        self.computed_dead_states = False
+        self.computed_target_distance = False
+        if char_index is None:
+            char_index = {char:i for i,char in enumerate(self.alphabet)}
+        self.num_states = num_states
+        self.table = table
+        self.char_index = char_index
+        self.num_columns = len(table)//num_states
+        self.num_edges = self.count_edges()
+        self.edges = TableEdges(self)
+
+    def compact(self):
+        # Moves the edges from the dictionaries to a compact table
+        # This uses 4 bytes per state and character class, and it is faster to walk on
+        if self.table is None:
+            table, char_index, cols = self.transition_table()
+            self.table = table
+            self.char_index = char_index
+            self.num_columns = cols
+            self.num_edges = self.count_edges()
+            self.edges = TableEdges(self)
+        return self
+
+    def freeze(self):
+        # Makes the dfa compact and read-only, so it can be shared safely
+        # The analysis of the states is done here, so readers never have to change anything
+        self.compact()
+        self.compute_dead_states()
+        self.count_graph()
+        self.frozen = True
+        return self
+
+    def to_bytes(self):
+        # Returns the dfa in a compact binary format, that from_bytes can read back
+        # The format is a header, the alphabet in utf-8, the column of every character,
+        # a bitmap of the target states, and finally the transition table as 32 bit integers
+        # The table starts at a multiple of 4 bytes, so that it can be used directly from a buffer
+        table, char_index, cols = self.transition_table()
+        alphabet = "".join(self.alphabet).encode('utf-8')
+        header = FORMAT_HEADER.pack(FORMAT_MAGIC,FORMAT_VERSION,self.num_states,self.start_state,
+            len(self.alphabet),cols,self.count_edges(),len(alphabet))
+
+        columns = array('i',[char_index[char] for char in self.alphabet])
+        targets = bytearray((self.num_states+7)//8)
+        for t in self.target_states:
+            targets[t//8] |= 1 << (t%8)
+
+        table = array('i',table)
+        if sys.byteorder != 'little':
+            columns.byteswap()
+            table.byteswap()
+        data = header+alphabet+columns.tobytes()+bytes(targets)
+        return data+bytes(-len(data)%4)+table.tobytes()
+
+    @staticmethod
+    def from_bytes(data, copy = True):
+        # Creates a dfa from the binary format of to_bytes
+        # Without copy, the table is used directly from the buffer (a bytes object or an mmap),
+        # so the dfa is frozen and the buffer must stay unchanged
+        view = memoryview(data).cast('B')
+        magic, version, num_states, start_state, num_chars, cols, num_edges, alphabet_size = FORMAT_HEADER.unpack_from(view,0)
+        if magic != FORMAT_MAGIC:
+            raise Exception("Tried to load something that is not a saved DFA")
+        if version != FORMAT_VERSION:
+            raise Exception("Tried to load a DFA saved with format version "+str(version))
+
+        # Check that the buffer holds everything the header claims, before anything is read
+        # The table starts after the padding to a multiple of 4 bytes
+        at = FORMAT_HEADER.size
+        size = at+alphabet_size+4*num_chars+(num_states+7)//8
+        size += -size%4
+        if len(view) < size+4*num_states*cols:
+            raise Exception("Tried to load a truncated DFA")
+
+        # Read the alphabet, the columns and the targets
+        alphabet = list(bytes(view[at:at+alphabet_size]).decode('utf-8'))
+        at += alphabet_size
+        columns = array('i',bytes(view[at:at+4*num_chars]))
+        at += 4*num_chars
+        targets = bytes(view[at:at+(num_states+7)//8])
+        at += (num_states+7)//8
+        at += -at%4
+
+        # Read the table, which is only copied if it has to be
+        if sys.byteorder != 'little':
+            columns.byteswap()
+            copy = True
+        if len(alphabet) != num_chars or any(not 0 <= c < cols for c in columns):
+            raise Exception("Tried to load a DFA with a broken alphabet")
+        table = view[at:at+4*num_states*cols]
+        if copy:
+            table = array('i',bytes(table))
+            if sys.byteorder != 'little':
+                table.byteswap()
+        else:
+            table = table.cast('i')
+
+        # Build the dfa around the table
+        new_dfa = DFA(alphabet)
+        new_dfa.num_states = num_states
+        new_dfa.start_state = start_state
+        new_dfa.table = table
+        new_dfa.char_index = {char:columns[i] for i,char in enumerate(new_dfa.alphabet)}
+        new_dfa.num_columns = cols
+        new_dfa.num_edges = num_edges
+        new_dfa.edges = TableEdges(new_dfa)
+        new_dfa.target_states = {s for s in range(num_states) if targets[s//8] >> (s%8) & 1}
+        if not copy:
+            new_dfa.buffer = data
+            new_dfa.frozen = True
+        return new_dfa
+
+    def save(self, path):
+        # Saves the dfa to a file in the binary format of to_bytes
+        with open(path,'wb') as f:
+            f.write(self.to_bytes())
+
+    @staticmethod
+    def load(path, mmap = True):
+        # Loads a dfa saved with save
+        # With mmap, the file is mapped read-only in memory and the table is used from there,
+        # so processes that load the same file share its memory. The dfa is then frozen
+        if not mmap:
+            with open(path,'rb') as f:
+                return DFA.from_bytes(f.read())
+
+        import mmap as mmap_module
+        with open(path,'rb') as f:
+            mapped = mmap_module.mmap(f.fileno(),0,access=mmap_module.ACCESS_READ)
+        return DFA.from_bytes(mapped,copy=False)
+
     def set_state_target(self,state, target):
         # Sets the target status of a state
+
+        # Frozen dfa's can't change
+        self.check_mutable()
         
         # Reset the computations
         self.computed_dead_states = False
@@ -136,6 +444,7 @@ class DFA:
         # Check incomplete
         if self.is_complete():
             return
+        self.check_mutable()
 
         # Find a dead state
         if self.computed_dead_states == False:
@@ -149,138 +458,313 @@ class DFA:
             dead_state = self.add_state()
 
         # Now that you have the dead state, add edges leading to it for all other incomplete states
+        if self.table is not None:
+            for i in range(len(self.table)):
+                if self.table[i] == -1:
+                    self.table[i] = dead_state
+            self.num_edges = self.num_states*len(self.alphabet)
+            return
         for i in range(self.num_states):
             for char in self.alphabet:
                 if char not in self.edges[i]:
                     self.edges[i][char] = dead_state
+        self.num_edges = self.num_states*len(self.alphabet)
 
     def negate(self):
         # Makes all the target states non-target, and all the non-target states target
         # Basically negates the dfa
+        # The missing edges lead to the implicit sink, which becomes a target as well, so a
+        # partial dfa needs a real sink state first. It is moved to the compact table, where
+        # that only costs a single row
+        if not self.is_complete():
+            self.compact()
+            self.make_complete()
         for i in range(self.num_states):
             self.set_state_target(i,i not in self.target_states)
 
+    def copy(self):
+        # Returns a new dfa that is the same as this one, but can be altered separately
+        # The copy is never frozen
+        new_dfa = DFA(self.alphabet)
+        if self.table is not None:
+            new_dfa.set_table(array('i',self.table),self.num_states,dict(self.char_index))
+        else:
+            new_dfa.num_states = self.num_states
+            new_dfa.num_edges = self.num_edges
+            new_dfa.edges = {s:dict(self.edges[s]) for s in self.edges}
+        new_dfa.start_state = self.start_state
+        new_dfa.target_states = set(self.target_states)
+        return new_dfa
+
+    def negated(self):
+        # Returns a new dfa that accepts exactly the strings this one rejects
+        # Unlike negate, this one is left as it is
+        new_dfa = self.copy()
+        new_dfa.negate()
+        return new_dfa
+
+    def minimize(self):
+        # Produces a new dfa with the minimum number of states that accepts the same language
+        # It uses Hopcroft's partition refinement, which runs in O(n*k*log(n))
+        # The states that can't reach a target are left out, their edges go to the implicit sink,
+        # and the rest are renumbered with the start state as 0
+
+        # The refinement works on the columns of the table, so characters of the same class
+        # are handled together
+        table, char_index, cols = self.transition_table()
+
+        # First keep only the states that are reachable from the start state
+        order = [self.start_state]
+        index = {self.start_state:0}
+        at = 0
+        while at < len(order):
+            base = order[at]*cols
+            for se in table[base:base+cols]:
+                if se != -1 and se not in index:
+                    index[se] = len(order)
+                    order.append(se)
+            at += 1
+
+        # Build the transition table on the renumbered states
+        # Missing edges lead to an extra sink state, which is only kept if it is needed
+        num = len(order)
+        sink = num
+        delta = []
+        need_sink = False
+        for state in order:
+            base = state*cols
+            row = [index[se] if se != -1 else sink for se in table[base:base+cols]]
+            if sink in row:
+                need_sink = True
+            delta.append(row)
+        if need_sink:
+            delta.append([sink]*cols)
+            num += 1
+
+        # For every character, find the states that lead to each state
+        inverse = [[[] for s in range(num)] for c in range(cols)]
+        for s in range(num):
+            for c in range(cols):
+                inverse[c][delta[s][c]].append(s)
+
+        # The initial partition separates target from non target states
+        targets = {i for i,state in enumerate(order) if state in self.target_states}
+        blocks = []
+        block_of = [0]*num
+        for part in (targets, set(range(num))-targets):
+            if len(part) != 0:
+                for s in part:
+                    block_of[s] = len(blocks)
+                blocks.append(set(part))
+
+        # The splitters that are pending, only the smaller block needs to be used
+        pending = set()
+        if len(blocks) == 2:
+            smaller = 0 if len(blocks[0]) <= len(blocks[1]) else 1
+            for c in range(cols):
+                pending.add((smaller,c))
+
+        # Refine the partition till no splitter is left
+        while len(pending) != 0:
+
+            # Find all the states that lead into the splitter
+            splitter, c = pending.pop()
+            touched = {}
+            for se in blocks[splitter]:
+                for ss in inverse[c][se]:
+                    touched.setdefault(block_of[ss],[]).append(ss)
+
+            # Split every block that is only partially touched
+            for block, inside in touched.items():
+                if len(inside) == len(blocks[block]):
+                    continue
+
+                # Move the touched states to a new block
+                new_block = len(blocks)
+                blocks[block].difference_update(inside)
+                blocks.append(set(inside))
+                for s in inside:
+                    block_of[s] = new_block
+
+                # Update the pending splitters
+                for d in range(cols):
+                    if (block,d) in pending:
+                        pending.add((new_block,d))
+                    elif len(blocks[new_block]) <= len(blocks[block]):
+                        pending.add((new_block,d))
+                    else:
+                        pending.add((block,d))
+
+        # The blocks that can reach a target block are found backwards from the targets
+        # After the refinement at most one block is left that can't, and it becomes the sink
+        reverse = [set() for block in blocks]
+        for block in range(len(blocks)):
+            rep = next(iter(blocks[block]))
+            for c in range(cols):
+                reverse[block_of[delta[rep][c]]].add(block)
+        live = {block_of[s] for s in targets}
+        frontier = list(live)
+        while len(frontier) != 0:
+            for block in reverse[frontier.pop()]:
+                if block not in live:
+                    live.add(block)
+                    frontier.append(block)
+
+        # Number the blocks in the order they are reached from the start state
+        mapping = {block_of[0]:0}
+        visit = [block_of[0]]
+        at = 0
+        while at < len(visit):
+            rep = next(iter(blocks[visit[at]]))
+            for c in range(cols):
+                nb = block_of[delta[rep][c]]
+                if nb not in mapping and nb in live:
+                    mapping[nb] = len(visit)
+                    visit.append(nb)
+            at += 1
+
+        # Create the new dfa from the blocks
+        new_table = array('i')
+        for block in visit:
+            rep = next(iter(blocks[block]))
+            new_table.extend(mapping[block_of[delta[rep][c]]] if block_of[delta[rep][c]] in live else -1 for c in range(cols))
+        new_table, new_index, new_cols = compress_table(new_table,dict(char_index),cols)
+        new_dfa = DFA(self.alphabet)
+        new_dfa.set_table(new_table,len(visit),new_index)
+        for block in visit:
+            if next(iter(blocks[block])) in targets:
+                new_dfa.set_state_target(mapping[block],True)
+
+        # Return the minimized dfa
+        return new_dfa
+
     def compute_dead_states(self):
         # This is run once and it speeds up other procedures
+        # Everything is computed in linear time on the number of edges
         
         # Check if you have done this before
         if self.computed_dead_states:
             return
 
-        def check_state_dead(state):
-            # This checks if a single state is dead
-            visited = set()
-            pending = [state]
-            
-            # Start from this state and do a breath-first till you find a target state
-            while True:
-                
-                if len(pending) == 0:
-                    break
-                
-                # Get the next state
-                state_at = pending.pop()
-                
-                # Check that it is not yet visited
-                if state_at in visited:
-                    continue
-                visited.add(state_at)
-                
-                if state_at in self.target_states:
-                    return False
-
-                # Add the other states
-                for char in self.edges[state_at]:
-                    pending.append(self.edges[state_at][char])
-            
-            return True
-        
-        for i in range(self.num_states):
-            if check_state_dead(i):
-                self.dead_states.add(i)
-                
-        # After you compute the dead states, you can compute the distance from each state
-        for i in self.dead_states:
-            self.target_distance[i] = 999999999999
-        for i in self.target_states:
-            self.target_distance[i] = 0
-        
-        for i in range(self.num_states):
-            visited = set()
-            visited.update(self.dead_states)
-            visited.update(self.target_states)
-            for s in range(self.num_states):
-                if s in visited:
-                    continue
-                found = False
-                self.target_distance[s] = 999999999999999
-                for s2 in self.edges[s].values():
-                    if s2 in self.target_distance:
-                        found = True
-                        if s not in self.target_distance or self.target_distance[s2]+1<self.target_distance[s]:
-                            self.target_distance[s] = self.target_distance[s2]+1
-
-        # Then you can compute the maximum distance each state has from a target
-        # To do that we need a function that computes if a state is part of a circle first
-        def check_state_cycle(state):
-
-            # Which states have already been processed
-            looked_at = set()
-
-            # Which states are pending for processing 
-            pending = [state]
-
-            # Process them all
-            while True:
-
-                # If a circle is non found yet, there is none
-                if len(pending) == 0:
-                    return False
+        self.dead_states = set()
+        self.target_distance = {}
+        self.counting_graph = None
+        self.sample_edges = None
+        self.python_source = None
+        self.python_matcher = None
+
+        # Find the states every state leads to from the table, which is faster to walk than the edges
+        table, char_index, cols = self.transition_table()
+        successors = []
+        for s in range(self.num_states):
+            row = set(table[s*cols:(s+1)*cols])
+            row.discard(-1)
+            successors.append(list(row))
+
+        # Build the reverse edges once, so that we can search backwards from the targets
+        reverse = {s:[] for s in range(self.num_states)}
+        for s in range(self.num_states):
+            for se in successors[s]:
+                reverse[se].append(s)
+
+        # A breadth-first search backwards from all the target states at once gives the
+        # distance of every state from its closest target state
+        frontier = list(self.target_states)
+        for s in frontier:
+            self.target_distance[s] = 0
+        while len(frontier) != 0:
+            next_frontier = []
+            for s in frontier:
+                for sp in reverse[s]:
+                    if sp not in self.target_distance:
+                        self.target_distance[sp] = self.target_distance[s]+1
+                        next_frontier.append(sp)
+            frontier = next_frontier
+
+        # The states that were not reached can never lead to a target, so they are dead
+        for s in range(self.num_states):
+            if s not in self.target_distance:
+                self.dead_states.add(s)
+                self.target_distance[s] = 999999999999
+
+        # Then you can compute the maximum distance the furthest state has from a target
+        # Only the states that are reachable from the start and are not dead matter
+        useful = set()
+        pending = [self.start_state]
+        while len(pending) != 0:
+            state_at = pending.pop()
+            if state_at in useful or state_at in self.dead_states:
+                continue
+            useful.add(state_at)
+            pending.extend(successors[state_at])
 
-                # Bring out the next pending state
-                state_at = pending.pop()
-                if state_at in looked_at:
-                    continue
-                looked_at.add(state_at)
-                    
-                # For that state, check every neighbor
-                for neighbor in self.edges[state_at].values():
-                    if neighbor == state:
-                        return True
-                    pending.append(neighbor)
-
-        # If a non dead state is part of a cycle, then the maximum distance from a target is infinite
+        # If a useful state is part of a cycle, the maximum distance is infinite
+        # The cycles are found with Tarjan's strongly connected components, which also
+        # gives us the components in reverse topological order
         self.target_max_length = -1
-        for i in range(self.num_states):
-            if i not in self.dead_states and check_state_cycle(i):
-                self.target_max_length = float('inf')
-        
-        # If there is no cycle in the valid paths, you just need to calculate the furthest path from the
-        # start state to one of the target states. For that, we need a dictionary for the maximum length
-        # from the start state
-        if self.target_max_length == -1:
-            distance_start = {}
-            pending = [(0,0)] # State, distance from start
-
-            while True:
-
-                # Check if you are done
-                if len(pending) == 0:
-                    break
-
-                # Get the next state
-                state_at, dist = pending.pop()
-                if state_at in distance_start and distance_start[state_at] <= dist:
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        cyclic = False
+        for root in useful:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root,iter(successors[root]))]
+            while len(work) != 0:
+                state_at, neighbors = work[-1]
+                advanced = False
+                for neighbor in neighbors:
+                    if neighbor not in useful:
+                        continue
+                    if neighbor == state_at:
+                        cyclic = True
+                    if neighbor not in index:
+                        index[neighbor] = low[neighbor] = len(index)
+                        stack.append(neighbor)
+                        on_stack.add(neighbor)
+                        work.append((neighbor,iter(successors[neighbor])))
+                        advanced = True
+                        break
+                    if neighbor in on_stack:
+                        low[state_at] = min(low[state_at],index[neighbor])
+                if advanced:
                     continue
-                distance_start[state_at] = dist
 
-                # See all the possible connections
-                for neighbor in self.edges[state_at].values():
-                    # Skip dead states
-                    if neighbor not in self.dead_states:
-                        pending.append((neighbor,dist+1))
-            
-            # Now you have all the distances you need, check the longest to a target state
+                # You are done with this state, check if it closes a component
+                work.pop()
+                if len(work) != 0:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent],low[state_at])
+                if low[state_at] == index[state_at]:
+                    component = []
+                    while True:
+                        s = stack.pop()
+                        on_stack.discard(s)
+                        component.append(s)
+                        if s == state_at:
+                            break
+                    if len(component) > 1:
+                        cyclic = True
+                    components.append(component)
+
+        if cyclic:
+            self.target_max_length = float('inf')
+        elif len(useful) != 0:
+            # If there is no cycle in the valid paths, you just need the longest path from the
+            # start state to one of the target states, which is found in topological order
+            distance_start = {self.start_state:0}
+            for component in reversed(components):
+                state_at = component[0]
+                if state_at not in distance_start:
+                    continue
+                for neighbor in successors[state_at]:
+                    if neighbor in useful:
+                        distance_start[neighbor] = max(distance_start.get(neighbor,0),distance_start[state_at]+1)
             for st in self.target_states:
                 if st in distance_start:
                     self.target_max_length = max(self.target_max_length, distance_start[st])
@@ -294,141 +778,514 @@ class DFA:
         
         # Start at the beginning
         state_at = self.start_state
+
+        # A compact dfa is walked directly on the table
+        if self.table is not None:
+            table = self.table
+            char_index = self.char_index
+            cols = self.num_columns
+            for char in string:
+                column = char_index.get(char)
+                if column is None:
+                    return False
+                state_at = table[state_at*cols+column]
+                if state_at == -1:
+                    return False
+            return state_at in self.target_states
         
-        # Loop through
+        # Loop through, a missing edge or a character outside the alphabet leads to the
+        # implicit sink that rejects everything
         for char in string:
-            state_at = self.edges[state_at][char]
+            state_at = self.edges[state_at].get(char)
+            if state_at is None:
+                return False
         
         # Check if you are at a target state
         return state_at in self.target_states
-    
-    def get_next_string(self, reset = False):
-        # This function will find all the strings till specified length that are accepted by the automaton
-        # Careful because it is slow as fuck
-        
-        # depth list contains (state, char_at)
-        # state is the state you are in
-        # char_at is the character you will be searching next
-        
-        # First of all, you have to have computed the dead states for this to work reliably
-        if not self.computed_dead_states:
-            self.compute_dead_states()
 
-        # If you wish to reset, you must clear all the helper variables
-        if reset:
-            self.next_len = 0
-            self.next_in = 1
-            self.depth_list = []
-            self.backtracked = False
-            
-        
-        # Special case for the null string
-        if self.next_len == 0:
-            self.next_len = 1
-            self.next_in = 1
-            self.depth_list.append((0,self.alphabet[0]))
-            if 0 in self.target_states:
-                return '<null_string>'
-        
-        # The next found string
-        result = ""
-        
-        # Dive into the tree till you are next_in = next_len
-        while True:
-
-            # Special case for when you are done
-            if self.target_max_length < self.next_len:
-                return None
-
-            if len(self.depth_list) == 0:
-                self.depth_list.append((0,self.alphabet[0]))
-                self.next_len += 1
-                self.next_in = 1
-                self.backtracked = False
+    def matcher(self, block_size = 1<<16):
+        # Returns a new matcher that checks a string that is given in chunks
+        return DFAMatcher(self,block_size)
+
+    def check_strings(self, strings, lengths = None):
+        # Checks many strings at once, and returns a numpy array of booleans
+        # The strings are either an iterable of strings, or a padded matrix of character codes
+        # with one row per string, along with the length of each row
+        # All the strings advance together on the transition table, one character at a time
+        # Characters outside the alphabet are rejected
+        import numpy as np
+
+        # Encode the strings into a matrix of character codes
+        if isinstance(strings, np.ndarray) and strings.dtype.kind in 'iu':
+            codes = strings.reshape(len(strings),strings.size//max(len(strings),1)).astype(np.int64)
+            if lengths is None:
+                lengths = np.full(len(codes),codes.shape[1])
+        else:
+            # The lengths are taken before numpy sees the strings, since it drops trailing '\x00'
+            # The padding is also 0, so only the lengths tell them apart
+            strings = list(strings)
+            lengths = np.array([len(string) for string in strings],dtype=np.int64)
+            width = max(int(lengths.max()) if len(strings) != 0 else 0,1)
+            strings = np.array(strings,dtype='<U'+str(width))
+            codes = strings.view(np.uint32).reshape(len(strings),width).astype(np.int64)
+        lengths = np.asarray(lengths)
+
+        # Extend the table with a rejecting sink state that takes the place of missing edges,
+        # a column for characters outside the alphabet that leads to the sink, and a column
+        # for the padding that leaves every state where it is
+        table, char_index, cols = self.transition_table()
+        sink = self.num_states
+        width = cols+2
+        full = np.empty((self.num_states+1,width),dtype=np.int64)
+        full[:-1,:cols] = np.array(table,dtype=np.int64).reshape(self.num_states,cols)
+        full[full == -1] = sink
+        full[-1,:] = sink
+        full[:,cols] = sink
+        full[:,cols+1] = np.arange(self.num_states+1)
+        full *= width
+
+        # Map the character codes to columns with a lookup array over the codes of the alphabet
+        top = max([ord(char) for char in char_index]+[0])
+        lookup = np.full(top+2,cols,dtype=np.int64)
+        for char in char_index:
+            lookup[ord(char)] = char_index[char]
+        codes[(codes < 0) | (codes > top)] = top+1
+        codes = lookup[codes]
+        codes[np.arange(codes.shape[1])[None,:] >= lengths[:,None]] = cols+1
+
+        # Advance all the strings together on the flattened table
+        full = full.ravel()
+        codes = np.ascontiguousarray(codes.T)
+        states = np.full(codes.shape[1],self.start_state*width,dtype=np.int64)
+        for column in codes:
+            states = full[states+column]
+        states //= width
+
+        # Check which strings ended at a target state
+        is_target = np.zeros(self.num_states+1,dtype=bool)
+        is_target[list(self.target_states)] = True
+        return is_target[states]
+
+    def compile_to_python(self):
+        # Generates the source of a matcher function specialized to this dfa, and returns the
+        # function. It gives the same answers as check_string, but characters outside the
+        # alphabet are rejected instead of raising an error
+        # Every useful state becomes a dict from its characters to the dict of the next state,
+        # so a step is a single lookup, and a missing key (a dead state or an unknown
+        # character) returns False at once. The target states hold the key 0
+        # A state whose self loop covers most of the alphabet also holds the key 1, a regular
+        # expression that skips the whole run of those characters with a single scan
+        # The source is kept in python_source and both are made again after every change
+        self.compute_dead_states()
+        if self.python_matcher is not None:
+            return self.python_matcher
+
+        table, char_index, cols = self.transition_table()
+        dead = self.dead_states
+        states = [{} for s in range(self.num_states)]
+        for char, c in char_index.items():
+            for s in range(self.num_states):
+                se = table[s*cols+c]
+                if se != -1 and s not in dead and se not in dead:
+                    states[s][char] = states[se]
+        for s in self.target_states:
+            states[s][0] = True
+
+        # Short runs are cheaper to step through than to scan, so only the states that loop
+        # on more than half of the alphabet get a scan
+        spans = False
+        for s in range(self.num_states):
+            loop = [char for char in char_index if table[s*cols+char_index[char]] == s]
+            if s not in dead and 2*len(loop) > len(char_index):
+                states[s][1] = re.compile('['+''.join(re.escape(char) for char in loop)+']*').match
+                spans = True
+
+        lines = ["def match(string):"]
+        namespace = {'START':states[self.start_state]}
+        if self.start_state in dead:
+            lines.append("    return False")
+        elif spans:
+            lines += ["    state = START",
+                      "    i = 0",
+                      "    n = len(string)",
+                      "    while i < n:",
+                      "        state = state.get(string[i])",
+                      "        if state is None:",
+                      "            return False",
+                      "        i += 1",
+                      "        if 1 in state:",
+                      "            i = state[1](string, i).end()",
+                      "    return 0 in state"]
+        else:
+            lines += ["    state = START",
+                      "    for char in string:",
+                      "        state = state.get(char)",
+                      "        if state is None:",
+                      "            return False",
+                      "    return 0 in state"]
+
+        self.python_source = "\n".join(lines)+"\n"
+        exec(compile(self.python_source,"<dfa matcher>","exec"),namespace)
+        self.python_matcher = namespace['match']
+        return self.python_matcher
+
+    def enumerate(self, max_len = None, start_after = None):
+        # Returns a generator of the accepted strings, in order of length and alphabetically
+        # for the same length. It can start right after a given string, to resume from a checkpoint
+        # Every generator is independent, so many can run at once, even from different threads
+        # on the same frozen dfa
+        self.compute_dead_states()
+
+        # There is no need to look past the longest accepted string
+        limit = self.target_max_length
+        if max_len is not None:
+            limit = min(limit,max_len)
+
+        length = 0 if start_after is None else len(start_after)
+        after = start_after
+        while length <= limit:
+            yield from self.strings_of_length(length,after)
+            after = None
+            length += 1
+
+    def strings_of_length(self, length, after = None):
+        # Generates the accepted strings of the given length alphabetically, after the given string
+        # The counts of sampling_tables tell which characters lead to an accepted string,
+        # so only branches that produce a string are ever followed
+        counts = self.sampling_tables(length)
+        if len(counts[0]) == 0 or counts[length][0] == 0:
+            return
+        ordered = self.sample_ordered
+
+        def first_option(state, depth, tight):
+            # While the prefix is the same as the given string, skip the smaller characters
+            if not tight or depth == length:
+                return 0
+            return bisect.bisect_left(ordered[state],(after[depth],))
+
+        # Every frame is [state, next option to try, whether the prefix equals the given string]
+        tight = after is not None
+        frames = [[0,first_option(0,0,tight),tight]]
+        prefix = []
+        while len(frames) != 0:
+            frame = frames[-1]
+            depth = len(frames)-1
+
+            # A full string is found, unless it is the given string itself
+            if depth == length:
+                if not frame[2]:
+                    yield "".join(prefix)
+                frames.pop()
+                if len(prefix) != 0:
+                    prefix.pop()
                 continue
-            
-            # Get the frame you are in
-            frame = self.depth_list[-1]
-            
-            # If you backtracked get the next character
-            if self.backtracked:
-                self.next_in -= 1
-                if frame[1] not in self.ab_next:
-                    # Backtrack further
-                    self.depth_list.pop()
-                    continue
-                else:
-                    # Skip to the next character
-                    self.depth_list[-1] = (frame[0],self.ab_next[frame[1]])
-                    self.backtracked = False
-                    frame = self.depth_list[-1]
-            
-            # If you are not at the correct level ascend forward
-            if self.next_len > self.next_in:
-                
-                # Check if you are hopeless first
-                if self.target_distance[frame[0]] > self.next_len-self.next_in+1:
-                    self.backtracked = True
-                    self.depth_list.pop()
-                    continue
-                
-                # Don't forward to a dead state
-                all_dead = False
-                while self.target_distance[self.edges[frame[0]][frame[1]]] > self.next_len-self.next_in+1:
-                    if frame[1] in self.ab_next:
-                        frame = (frame[0],self.ab_next[frame[1]])
-                        break
-                    else:
-                        all_dead = True
-                        break
-                
-                # If all else states are dead, you need to backtrack
-                if all_dead:
-                    self.backtracked = True
-                    self.depth_list.pop()
-                    continue
-                
-                # If some state is not dead, just visit it forward
-                self.depth_list[-1] = frame
-                self.next_in += 1
-                self.depth_list.append((self.edges[frame[0]][frame[1]],self.alphabet[0]))
+
+            # Find the next character that leads to a state with accepted strings
+            options = ordered[frame[0]]
+            remaining = counts[length-depth-1]
+            opt = frame[1]
+            while opt < len(options) and remaining[options[opt][1]] == 0:
+                opt += 1
+            if opt == len(options):
+                frames.pop()
+                if len(prefix) != 0:
+                    prefix.pop()
                 continue
-            
-            # There you are at the correct level, start checking where they all lead
-            # Till you find one that leads to a target state
-            found = False
-            while True:
-                if self.edges[frame[0]][frame[1]] in self.target_states:
-                    found = True
+
+            # Go forward with that character
+            frame[1] = opt+1
+            char, se = options[opt]
+            tight = frame[2] and char == after[depth]
+            prefix.append(char)
+            frames.append([se,first_option(se,depth+1,tight),tight])
+
+    def unrank(self, k):
+        # Returns the k-th accepted string (starting from 0), in the order of enumerate
+        # It goes straight to the string using the counts, so the strings before it are never made
+        # Returns None if there are not that many accepted strings
+        self.compute_dead_states()
+        if k < 0:
+            return None
+
+        # Find the length of the string by skipping whole lengths
+        length = 0
+        while True:
+            if length > self.target_max_length:
+                return None
+            counts = self.sampling_tables(length)
+            if len(counts[0]) == 0:
+                return None
+            if k < counts[length][0]:
+                break
+            k -= counts[length][0]
+            length += 1
+
+        # Then choose every character by skipping the ones that lead to fewer strings than needed
+        ordered = self.sample_ordered
+        state_at = 0
+        string = []
+        for depth in range(length):
+            remaining = counts[length-depth-1]
+            for char, se in ordered[state_at]:
+                if k < remaining[se]:
                     break
-                elif frame[1] in self.ab_next:
-                    frame = (frame[0],self.ab_next[frame[1]])
+                k -= remaining[se]
+            string.append(char)
+            state_at = se
+        return "".join(string)
+
+    def rank(self, string):
+        # Returns how many accepted strings come before the given one, in the order of enumerate
+        # For an accepted string this is its index, so that unrank(rank(string)) == string
+        self.compute_dead_states()
+        counts = self.sampling_tables(len(string))
+        if len(counts[0]) == 0:
+            return 0
+
+        # All the shorter strings come first
+        length = len(string)
+        result = sum(counts[l][0] for l in range(length))
+
+        # Then the strings of the same length that are smaller alphabetically
+        ordered = self.sample_ordered
+        state_at = 0
+        for depth in range(length):
+            remaining = counts[length-depth-1]
+            next_state = None
+            for char, se in ordered[state_at]:
+                if char < string[depth]:
+                    result += remaining[se]
+                elif char == string[depth]:
+                    next_state = se
                 else:
-                    # You have consumed everything and found nothing
                     break
-            
-            # If you didn't find it, you need to backtrack
-            if not found:
-                self.backtracked = True
-                self.depth_list.pop()
-                continue
-            else:
-                # You found it, so update the table
-                self.depth_list[-1] = (frame[0],frame[1])
-                
-                # Construct the string
-                for el in self.depth_list:
-                    result += el[1]
-                
-                # Try to go the next character
-                if frame[1] not in self.ab_next:
-                    # You need to backtrack
-                    self.backtracked = True
-                    self.depth_list.pop()
-                    return result
-                else:
-                    self.depth_list[-1] = (frame[0],self.ab_next[frame[1]])
-                    return result
+            if next_state is None:
+                return result
+            state_at = next_state
+        return result
+
+    def get_next_string(self, reset = False):
+        # Returns the next accepted string, in order of length and alphabetically for the same length
+        # The null string is returned as '<null_string>', and None is returned when there are no more
+        # This keeps one enumeration on the dfa itself, use enumerate for independent ones
+        if reset or self.next_strings is None:
+            self.next_strings = self.enumerate()
+        string = next(self.next_strings,None)
+        if string == "":
+            return '<null_string>'
+        return string
+
+    def equivalent(self, other, witness = False):
+        # Checks if the two dfa's accept the same language, with the union-find algorithm
+        # of Hopcroft and Karp, which is almost linear on the number of states
+        # With witness, it returns a pair of the answer and the shortest string that only
+        # one of them accepts (None if they are equivalent)
+
+        # DFA's must have the same alphabet
+        if self.alphabet != other.alphabet:
+            print("Tried to compare dfa's with different alphabet")
+            return
+
+        table1, index1, cols1 = self.transition_table()
+        table2, index2, cols2 = other.transition_table()
+        columns = list(dict.fromkeys((index1[char],index2[char]) for char in self.alphabet))
+
+        # The states of both dfa's are put in one union-find structure, the states of the
+        # second one come after the ones of the first, and each one has a rejecting sink at the end
+        offset = self.num_states
+        sink1 = self.num_states+other.num_states
+        sink2 = sink1+1
+        parent = list(range(sink2+1))
+
+        def find(x):
+            # Finds the representative of the set, halving the path on the way
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        def accepting(x):
+            if x < offset:
+                return x in self.target_states
+            if x < sink1:
+                return x-offset in other.target_states
+            return False
+
+        # Start from the two start states, and merge every pair that must be equivalent
+        # If a merged pair disagrees on being a target, the languages are different
+        same = True
+        pending = [(self.start_state,other.start_state+offset)]
+        parent[find(pending[0][0])] = find(pending[0][1])
+        while len(pending) != 0 and same:
+            s1, s2 = pending.pop()
+            if accepting(s1) != accepting(s2):
+                same = False
+                break
+            for c1, c2 in columns:
+                n1 = table1[s1*cols1+c1] if s1 != sink1 else -1
+                n2 = table2[(s2-offset)*cols2+c2] if s2 != sink2 else -1
+                n1 = sink1 if n1 == -1 else n1
+                n2 = sink2 if n2 == -1 else n2+offset
+                r1 = find(n1)
+                r2 = find(n2)
+                if r1 != r2:
+                    parent[r1] = r2
+                    pending.append((n1,n2))
+
+        if not witness:
+            return same
+        if same:
+            return (True,None)
+
+        # The shortest string that only one accepts is found breadth-first on the product
+        return (False,lazy_combine_DFA(self,other,'^').shortest_string())
+
+    def includes(self, other, witness = False):
+        # Checks if every string accepted by the other dfa is accepted by this one
+        # The product of their difference is searched lazily and stops at the first string
+        # that is missing, which is also the shortest one
+        # With witness, it returns a pair of the answer and that string (None if there is none)
+
+        # DFA's must have the same alphabet
+        if self.alphabet != other.alphabet:
+            print("Tried to compare dfa's with different alphabet")
+            return
+
+        missing = lazy_combine_DFA(other,self,'-').shortest_string()
+        if witness:
+            return (missing is None,missing)
+        return missing is None
+
+    def count_graph(self):
+        # Returns the graph that is used for counting strings, which only has the states that are
+        # reachable from the start and are not dead. It is a pair of the states and their rows,
+        # and every row maps the index of a next state to how many characters lead to it
+        # The graph is kept until the dfa changes
+        self.compute_dead_states()
+        if self.counting_graph is not None:
+            return self.counting_graph
+
+        table, char_index, cols = self.transition_table()
+        class_size = [0]*cols
+        for char in char_index:
+            class_size[char_index[char]] += 1
+
+        # Number the useful states in the order they are found from the start
+        states = []
+        index = {}
+        if self.start_state not in self.dead_states:
+            states.append(self.start_state)
+            index[self.start_state] = 0
+        rows = []
+        at = 0
+        while at < len(states):
+            base = states[at]*cols
+            row = {}
+            for c in range(cols):
+                se = table[base+c]
+                if se == -1 or se in self.dead_states:
+                    continue
+                if se not in index:
+                    index[se] = len(states)
+                    states.append(se)
+                row[index[se]] = row.get(index[se],0)+class_size[c]
+            rows.append(row)
+            at += 1
+
+        self.counting_graph = (states,rows)
+        return self.counting_graph
+
+    def count(self, n, modulus = None):
+        # Returns how many strings of exactly n characters are accepted
+        return self.count_paths(n,False,modulus)
+
+    def count_upto(self, n, modulus = None):
+        # Returns how many strings of at most n characters are accepted
+        return self.count_paths(n,True,modulus)
+
+    def count_paths(self, n, upto, modulus):
+        # Counts the accepted strings of length n (or up to n), optionally modulo a number
+        # For small n a dynamic program walks the graph n times, for large n the matrix
+        # of the graph is raised to the n-th power by repeated squaring
+        states, rows = self.count_graph()
+        if len(states) == 0 or n < 0:
+            return 0
+        targets = [i for i,s in enumerate(states) if s in self.target_states]
+
+        def reduce(x):
+            return x % modulus if modulus is not None else x
+
+        # Choose whichever is cheaper
+        num = len(states)
+        num_edges = sum(len(row) for row in rows)
+        if n*num_edges <= num**3*n.bit_length():
+
+            # Move the number of ways to reach each state one character at a time
+            ways = {0:1}
+            total = sum(ways.get(t,0) for t in targets)
+            for i in range(n):
+                next_ways = {}
+                for s, w in ways.items():
+                    for se, mult in rows[s].items():
+                        next_ways[se] = reduce(next_ways.get(se,0)+w*mult)
+                ways = next_ways
+                total = reduce(total+sum(ways.get(t,0) for t in targets))
+            if upto:
+                return total
+            return sum(ways.get(t,0) for t in targets) if modulus is None else reduce(sum(ways.get(t,0) for t in targets))
+
+        # Build the matrix of the graph, to count up to n an extra state collects every string
+        # that reaches a target, so the paths of n+1 steps that end there are the ones needed
+        size = num+1 if upto else num
+        matrix = [[0]*size for i in range(size)]
+        for s in range(num):
+            for se, mult in rows[s].items():
+                matrix[s][se] = mult
+        if upto:
+            for t in targets:
+                matrix[t][num] = 1
+            matrix[num][num] = 1
+            n += 1
+
+        # With a small enough modulus the products fit in 64 bits, so numpy can be used if it's there
+        use_numpy = False
+        if modulus is not None and (modulus-1)**2*size < 2**63:
+            try:
+                import numpy as np
+                use_numpy = True
+            except ImportError:
+                pass
+
+        def multiply(a, b):
+            # Multiplies two square matrices, skipping the zeros of the first
+            if use_numpy:
+                return ((np.array(a,dtype=np.int64) @ np.array(b,dtype=np.int64)) % modulus).tolist()
+            result = []
+            for row in a:
+                new_row = [0]*size
+                for k, x in enumerate(row):
+                    if x == 0:
+                        continue
+                    bk = b[k]
+                    for j in range(size):
+                        if bk[j] != 0:
+                            new_row[j] += x*bk[j]
+                result.append([reduce(v) for v in new_row])
+            return result
+
+        # Raise the matrix to the n-th power, keeping only the row of the start state
+        vector = [[1 if i == 0 else 0 for i in range(size)]]
+        power = matrix
+        while n > 0:
+            if n & 1:
+                vector = multiply(vector,power)
+            n >>= 1
+            if n > 0:
+                power = multiply(power,power)
+
+        if upto:
+            return vector[0][num]
+        return reduce(sum(vector[0][t] for t in targets))
 
     def extract_nfa(self):
         # Creates and extracts the nfa from this dfa
@@ -441,12 +1298,16 @@ class DFA:
         for i in range(self.num_states-1):
             new_nfa.add_state()
 
-        # Add the appropriate edges
+        # Add the appropriate edges, they are read from the table
+        table, char_index, cols = self.transition_table()
         for state in range(self.num_states):
+            base = state*cols
             # Search it's edges
-            for char in self.edges[state]:
-                # Add each one to the nfa
-                new_nfa.add_edge(state,self.edges[state][char],char)
+            for char in char_index:
+                se = table[base+char_index[char]]
+                if se != -1:
+                    # Add each one to the nfa
+                    new_nfa.add_edge(state,se,char)
 
         # Finally determine which are target
         for ts in self.target_states:
@@ -455,195 +1316,628 @@ class DFA:
         # And after all this, return the nfa
         return new_nfa
 
-    def generate(self,num_chars):
+    def sampling_tables(self, num_chars):
+        # Prepares what generate and enumerate need to find strings of up to num_chars characters
+        # For every useful state, the edges are kept as (next state, characters that lead there)
+        # and as (character, next state) in the order of the alphabet,
+        # and counts[r][i] holds how many accepted strings of r characters start from state i
+        # The tables are kept until the dfa changes, and only grow when longer strings are asked
+        # They are always replaced and never changed in place, so that many threads can share them
+        states, rows = self.count_graph()
+        if self.sample_edges is None:
+            index = {s:i for i,s in enumerate(states)}
+            table, char_index, cols = self.transition_table()
+            edges = []
+            ordered = []
+            for s in states:
+                chars = {}
+                for char in char_index:
+                    se = table[s*cols+char_index[char]]
+                    if se in index:
+                        chars.setdefault(index[se],[]).append(char)
+                edges.append(list(chars.items()))
+                ordered.append(sorted((char,se) for se in chars for char in chars[se]))
+            self.sample_counts = [[1 if s in self.target_states else 0 for s in states]]
+            self.sample_cumulative = {}
+            self.sample_ordered = ordered
+            self.sample_edges = edges
+
+        # Count the strings of every length that is not counted yet
+        counts = self.sample_counts
+        if len(counts) <= num_chars:
+            counts = list(counts)
+            while len(counts) <= num_chars:
+                prev = counts[-1]
+                counts.append([sum(len(chars)*prev[se] for se, chars in edges) for edges in self.sample_edges])
+            self.sample_counts = counts
+        return counts
+
+    def generate(self,num_chars,rng = random):
         # This is a function that will randomly generate a string that has exactly n characters
-        # and is accepted by the automaton
-        # It is also close to obsolete, may redo in the future
-        
-        # This will hold info on where this is visited from
-        # It holds info in the form of (state_from, char_at)
-        state_from = {}
-        for i in range(self.num_states):
-            state_from[i] = []
-            
-        state_from[0].append((None,-1,1))
-        
-        # Set a different dictionary to count how many times each is visited in each time
-        visit_times = [[0]*self.num_states]*(num_chars+1)
-        visit_times[0][0] = 1
-        
-        
-        for i in range(num_chars):
-            from_old = state_from.copy()
-            for s in from_old: # For every state that has been visited before
-                for e in from_old[s]: # For every visit that came to that state
-                    if e[1] == i-1: # If it came at character i-1
-                        sv = set()
-                        for st in self.edges[s].values(): # Then add this state as a precursor for every state that it will visit
-                            state_from[st].append((s,i)) # And set the character cound of that visit to i
-                            sv.add(st)
-                        for st in sv:
-                            visit_times[i+1][st] += visit_times[i][s]
-                        break # You break because you don't care how many they have visited it, just that it has i-1 count
-        
-        # This function will choose a state according to odds
-        def choose_probs(viable,odds):
-
-            # Viablity odd sum
-            vos = []
-            at = 0
-            for s in viable:
-                at += odds[s]
-                vos.append(at)
-                
-            # Choose between at
-            chosen = random.random()*at
-            for i in range(len(vos)):
-                if chosen <= vos[i]:
-                    return viable[i]
-            
-            
-            pass
-        
-        chars_need = num_chars-1
-        state_at = None
-        ves =  [ts for ts in self.target_states if chars_need in [x[1] for x in state_from[ts]]] # These are the viable end states
-        if len(ves) == 0:
+        # and is accepted by the automaton. Every such string is equally likely
+        # It returns None if there is no such string
+        counts = self.sampling_tables(num_chars)
+        if len(counts[0]) == 0 or counts[num_chars][0] == 0:
             return None
-        else:
-            state_at = choose_probs(list(ves),visit_times[chars_need+1])#ves[random.randint(0,len(ves)-1)] # Choose a random viable end state
-        string = ""
-        
-        while chars_need >= 0:
-            vps = set(); # These are the viable previous states
-            for x in state_from[state_at]:
-                if x[1] == chars_need:
-                    vps.add(x[0])
-            
-            # Choose one vps at random
-            prev_state = choose_probs(list(vps),visit_times[chars_need+1])#list(vps)[random.randint(0,len(vps)-1)]
-            
-            # See all the viable characters that lead there
-            vc = set()
-            for char in self.edges[prev_state]:
-                if self.edges[prev_state][char] == state_at:
-                    vc.add(char)
-            
-            # Choose the character to add to the string
-            char = list(vc)[random.randint(0,len(vc)-1)]
-            
-            # Do the step
-            string = char+string
-            state_at = prev_state
-            chars_need -= 1
-        
-        return string
 
+        # Walk from the start, and at every step choose the next state according to how many
+        # accepted strings go through it, then choose one of the characters that lead there
+        string = []
+        state_at = 0
+        for remaining in range(num_chars,0,-1):
+
+            # The running sums of the choices are kept, so each choice is a binary search
+            key = (state_at,remaining)
+            if key not in self.sample_cumulative:
+                at = 0
+                sums = []
+                for se, chars in self.sample_edges[state_at]:
+                    at += len(chars)*counts[remaining-1][se]
+                    sums.append(at)
+                self.sample_cumulative[key] = sums
+            sums = self.sample_cumulative[key]
+
+            chosen = bisect.bisect_right(sums,rng.randrange(sums[-1]))
+            state_at, chars = self.sample_edges[state_at][chosen]
+            string.append(chars[rng.randrange(len(chars))])
+
+        return "".join(string)
+
+    def generate_many(self, num_chars, count, seed = None):
+        # Generates many random strings of exactly n characters, each one picked uniformly
+        # The seed makes the result repeatable. It returns an empty list if there is no such string
+        rng = random.Random(seed)
+        counts = self.sampling_tables(num_chars)
+        if len(counts[0]) == 0 or counts[num_chars][0] == 0:
+            return []
+        return [self.generate(num_chars,rng) for i in range(count)]
+
+def compress_table(table, char_index, cols):
+    # Merges the columns of a transition table that are the same in every state
+    # The characters of the merged columns form a class, and they share a single column
+    # Returns the new table, character to column map and number of columns
+    if cols == 0:
+        return (table, char_index, cols)
+
+    # Find the distinct columns, in the order they first appear
+    column_of = {}
+    kept = []
+    remap = []
+    for c in range(cols):
+        key = table[c::cols].tobytes()
+        if key not in column_of:
+            column_of[key] = len(kept)
+            kept.append(c)
+        remap.append(column_of[key])
+
+    # If all the columns are different there is nothing to merge
+    if len(kept) == cols:
+        return (table, char_index, cols)
+
+    # Build the table with only the distinct columns
+    new_table = array('i')
+    for base in range(0,len(table),cols):
+        new_table.extend(table[base+c] for c in kept)
+    return (new_table, {char:remap[char_index[char]] for char in char_index}, len(kept))
+
+class DFAMatcher:
+    # Checks a string against a dfa while the string is given in chunks
+    # Chunks can be strings, bytes (each byte is a character), mmap regions or file objects,
+    # so big inputs can be checked without holding them in memory
+    # Once a dead state is reached the rest of the input is skipped, since it can't be accepted
+
+    def __init__(self, dfa:DFA, block_size = 1<<16):
+        self.dfa = dfa
+        self.block_size = block_size
+        self.table, self.char_index, self.cols = dfa.transition_table()
+
+        # Mark which states are dead, the state -1 (missing edge) is also dead
+        dfa.compute_dead_states()
+        self.dead = [False]*(dfa.num_states+1)
+        for s in dfa.dead_states:
+            self.dead[s] = True
+        self.dead[-1] = True
+
+        self.reset()
+
+    def reset(self):
+        # Starts over with an empty input
+        self.state = self.dfa.start_state
+        self.position = 0 # How many characters have been read
+
+    def is_dead(self):
+        # Returns whether the input is certainly rejected, whatever comes next
+        return self.dead[self.state]
+
+    def accepted(self):
+        # Returns whether the input so far is accepted
+        return self.state in self.dfa.target_states
+
+    def feed(self, chunk):
+        # Reads the next chunk of the input and returns the matcher
+
+        # Nothing more needs to be read after a dead state
+        if self.is_dead():
+            return self
+
+        # File objects are read one block at a time
+        if hasattr(chunk,'read'):
+            while not self.is_dead():
+                block = chunk.read(self.block_size)
+                if len(block) == 0:
+                    break
+                self.feed(block)
+            return self
+
+        # Strings are walked directly
+        if isinstance(chunk,str):
+            self.feed_string(chunk)
+            return self
+
+        # Anything else is treated as a buffer of bytes, which is decoded one block at a time
+        view = memoryview(chunk).cast('B')
+        at = 0
+        while at < len(view) and not self.is_dead():
+            self.feed_string(bytes(view[at:at+self.block_size]).decode('latin-1'))
+            at += self.block_size
+        return self
+
+    def feed_string(self, string):
+        # Walks the string on the table, stopping at the first dead state
+        table = self.table
+        char_index = self.char_index
+        cols = self.cols
+        dead = self.dead
+        state_at = self.state
+        read = 0
+        for char in string:
+            read += 1
+            column = char_index.get(char)
+            if column is None:
+                state_at = -1
+            else:
+                state_at = table[state_at*cols+column]
+            if dead[state_at]:
+                break
+        self.state = state_at
+        self.position += read
+
+class NFAMatcher(DFAMatcher):
+    # Like DFAMatcher, but it follows all the states of an nfa at once (see NFA.check_string)
+    # The state is a bitset of the states of the nfa, and it is dead when no state is left
+
+    def __init__(self, nfa:NFA, block_size = 1<<16):
+        self.nfa = nfa
+        self.block_size = block_size
+        self.start = nfa.compute_closures()[nfa.start_state]
+        self.targets = nfa.target_bits()
+        self.reset()
+
+    def reset(self):
+        # Starts over with an empty input
+        self.state = self.start
+        self.position = 0
+
+    def is_dead(self):
+        return self.state == 0
+
+    def accepted(self):
+        return self.state & self.targets != 0
+
+    def feed_string(self, string):
+        # Follows the states with every character, stopping when none is left
+        step = self.nfa.step
+        states = self.state
+        read = 0
+        for char in string:
+            read += 1
+            states = step(states,char)
+            if states == 0:
+                break
+        self.state = states
+        self.position += read
+
+class LazyDFA:
+    # This is the dfa of an nfa, but its states are only found while strings are checked, and
+    # only a limited number of them is kept (like the dfa cache of RE2). Every state is a
+    # bitset of states of the nfa (see NFA.step), and its edges are filled when they are used
+    # When there are too many states, all of them are forgotten and found again as needed,
+    # so the memory stays bounded even for patterns whose whole dfa would be huge
+    # States are numbered in the order they are found, the start state is 0 and -1 rejects
+
+    def __init__(self, nfa:NFA, max_states = 4096):
+        self.nfa = nfa
+        self.max_states = max(max_states,2)
+        self.min_progress = 10 # How many characters a new state must last for on average
+        self.start_set = nfa.compute_closures()[nfa.start_state]
+        self.targets = nfa.target_bits()
+        self.alphabet = sorted(nfa.derive_alphabet())
+        self.char_index = {char:i for i,char in enumerate(self.alphabet)}
+        self.cols = len(self.alphabet)
+
+        # The states found so far, and a table of their edges where -2 is an edge not yet found
+        # The lists are only cleared when flushed, never replaced, so they can be kept in locals
+        self.sets = []
+        self.state_map = {}
+        self.table = []
+        self.accepting = []
+        self.flushes = 0
+        self.state_of(self.start_set)
+
+    def flush(self):
+        # Forgets all the states that were found, except for the start state
+        self.sets.clear()
+        self.state_map.clear()
+        del self.table[:]
+        self.accepting.clear()
+        self.state_of(self.start_set)
+        self.flushes += 1
+
+    def state_of(self, states):
+        # Returns the number of the state of a bitset of states of the nfa, adding it if needed
+        # There is always room for it, the table is flushed first if it is full
+        if states in self.state_map:
+            return self.state_map[states]
+        if len(self.sets) >= self.max_states:
+            self.flush()
+        self.state_map[states] = len(self.sets)
+        self.sets.append(states)
+        self.accepting.append(states & self.targets != 0)
+        self.table.extend([-2]*self.cols)
+        return len(self.sets)-1
+
+    def find_edge(self, state, column):
+        # Finds the edge of a state that was not used before
+        states = self.nfa.step(self.sets[state],self.alphabet[column])
+        if states == 0:
+            self.table[state*self.cols+column] = -1
+            return -1
+        flushes = self.flushes
+        se = self.state_of(states)
+        # If the states were forgotten to make room, the state the edge starts from is gone
+        if flushes == self.flushes:
+            self.table[state*self.cols+column] = se
+        return se
+
+    def next_state(self, state_from, char):
+        if char not in self.char_index:
+            return -1
+        se = self.table[state_from*self.cols+self.char_index[char]]
+        if se == -2:
+            se = self.find_edge(state_from,self.char_index[char])
+        return se
+
+    def check_string(self, string):
+        # Checks if a string is accepted, finding the states on its path that are not known yet
+        # If almost every character finds a new state, the states are forgotten again before
+        # they are used, so the rest of the string is checked on the nfa instead (like RE2 does)
+        table = self.table
+        char_index = self.char_index
+        cols = self.cols
+        state_at = 0
+        misses = 0
+        for position, char in enumerate(string):
+            column = char_index.get(char)
+            if column is None:
+                return False
+            se = table[state_at*cols+column]
+            if se == -2:
+                misses += 1
+                if misses > self.max_states and misses*self.min_progress > position:
+                    return self.check_on_nfa(self.sets[state_at],string[position:])
+                se = self.find_edge(state_at,column)
+            if se == -1:
+                return False
+            state_at = se
+        return self.accepting[state_at]
+
+    def check_on_nfa(self, states, string):
+        # Checks the rest of a string from a bitset of states, following the nfa directly
+        step = self.nfa.step
+        for char in string:
+            states = step(states,char)
+            if states == 0:
+                return False
+        return states & self.targets != 0
+
+    def matcher(self, block_size = 1<<16):
+        # Returns a new matcher that checks a string that is given in chunks (see DFAMatcher)
+        return LazyDFAMatcher(self,block_size)
+
+    def stats(self):
+        # Returns how many states are kept, and how many times they were forgotten
+        return {'states':len(self.sets), 'max_states':self.max_states, 'flushes':self.flushes}
+
+class LazyDFAMatcher(DFAMatcher):
+    # Like DFAMatcher, but on a LazyDFA
+    # Between chunks the state is kept as its bitset, since the number of the state can change
+    # if the lazy dfa is flushed while something else uses it
+
+    def __init__(self, dfa:LazyDFA, block_size = 1<<16):
+        self.dfa = dfa
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        # Starts over with an empty input
+        self.state = self.dfa.start_set
+        self.position = 0
+
+    def is_dead(self):
+        return self.state == 0
+
+    def accepted(self):
+        return self.state & self.dfa.targets != 0
+
+    def feed_string(self, string):
+        # Walks the string on the lazy dfa, stopping at the rejecting state
+        if self.state == 0:
+            return
+        dfa = self.dfa
+        table = dfa.table
+        char_index = dfa.char_index
+        cols = dfa.cols
+        state_at = dfa.state_of(self.state)
+        read = 0
+        for char in string:
+            read += 1
+            column = char_index.get(char)
+            se = -1 if column is None else table[state_at*cols+column]
+            if se == -2:
+                se = dfa.find_edge(state_at,column)
+            if se == -1:
+                self.state = 0
+                self.position += read
+                return
+            state_at = se
+        self.state = dfa.sets[state_at]
+        self.position += read
+
+class LazyProductDFA:
+    # This is the product of two dfa's, like the one combine_DFA makes, but its states are
+    # only found when they are needed. Questions like "is the combination empty" can then stop
+    # as soon as they find an answer, without building the whole product
+    # States are numbered in the order they are found, and the start state is 0
+
+    def __init__(self, dfa1:DFA, dfa2:DFA, mode):
+
+        # The product is walked on the transition tables of the two dfa's
+        # A missing edge leads to the rejecting state -1, which only leads to itself,
+        # so the dfa's don't need to be made complete (and they are left untouched)
+        # The pairs that can never be accepted because of such a sink are the sink of the
+        # product as well, so they are left as missing edges instead of becoming states
+        self.dfa1 = dfa1
+        self.dfa2 = dfa2
+        self.mode = mode
+        self.alphabet = dfa1.alphabet.copy()
+        self.table1, index1, self.cols1 = dfa1.transition_table()
+        self.table2, index2, self.cols2 = dfa2.transition_table()
+
+        # Characters that are in the same class in both dfa's are in the same class in the product,
+        # so the product only needs a column for every pair of classes
+        self.columns = []
+        self.char_index = {}
+        pair_column = {}
+        for char in self.alphabet:
+            pair = (index1[char],index2[char])
+            if pair not in pair_column:
+                pair_column[pair] = len(self.columns)
+                self.columns.append(pair)
+            self.char_index[char] = pair_column[pair]
+
+        # According to the mode, map which pairs of states are final, and which are not
+        self.pair_target = {
+            '|': lambda x : x[0] in dfa1.target_states or x[1] in dfa2.target_states,
+            '&': lambda x : x[0] in dfa1.target_states and x[1] in dfa2.target_states,
+            '-': lambda x : x[0] in dfa1.target_states and x[1] not in dfa2.target_states,
+            '^': lambda x : (x[0] in dfa1.target_states) != (x[1] in dfa2.target_states),
+        }[mode]
+        self.pair_sink = {
+            '|': lambda x : x[0] == -1 and x[1] == -1,
+            '&': lambda x : x[0] == -1 or x[1] == -1,
+            '-': lambda x : x[0] == -1,
+            '^': lambda x : x[0] == -1 and x[1] == -1,
+        }[mode]
+
+        # The states found so far, and the rows of edges computed so far
+        self.start_state = 0
+        start = (dfa1.start_state,dfa2.start_state)
+        self.states = [start]
+        self.state_map = {start:0}
+        self.rows = {}
+
+    @property
+    def num_states(self):
+        # The number of states found so far
+        return len(self.states)
+
+    def row(self, state):
+        # Returns the edges of a state, one for every column, computing them if needed
+        if state in self.rows:
+            return self.rows[state]
+
+        s1, s2 = self.states[state]
+        base1 = s1*self.cols1
+        base2 = s2*self.cols2
+        row = []
+        for c1, c2 in self.columns:
+
+            # Find the new state for the character
+            state_next = (self.table1[base1+c1] if s1 != -1 else -1, self.table2[base2+c2] if s2 != -1 else -1)
+            if self.pair_sink(state_next):
+                row.append(-1)
+                continue
+
+            # Give it a number if it is new
+            if state_next not in self.state_map:
+                self.state_map[state_next] = len(self.states)
+                self.states.append(state_next)
+            row.append(self.state_map[state_next])
+
+        self.rows[state] = row
+        return row
+
+    def next_state(self, state_from, char):
+        if char not in self.char_index:
+            return -1
+        return self.row(state_from)[self.char_index[char]]
+
+    def find_state(self, state_from, char):
+        st = self.next_state(state_from,char)
+        return (st,self.is_target(st))
+
+    def is_target(self, state):
+        if state == -1:
+            return False
+        return self.pair_target(self.states[state])
+
+    def is_dead(self, state):
+        # Returns true if the state surely can't lead to a target state
+        # This only uses the dead states of the two dfa's, so some dead states are missed
+        if state == -1:
+            return True
+        s1, s2 = self.states[state]
+        dead1 = s1 == -1 or s1 in self.dfa1.dead_states
+        dead2 = s2 == -1 or s2 in self.dfa2.dead_states
+        if self.mode in {'|','^'}:
+            return dead1 and dead2
+        if self.mode == '&':
+            return dead1 or dead2
+        return dead1
+
+    def check_string(self, string):
+        # Checks if a string is accepted, finding only the states on its path
+        # Characters outside the alphabet are rejected, like in DFA.check_string
+        state_at = self.start_state
+        for char in string:
+            column = self.char_index.get(char)
+            if column is None:
+                return False
+            state_at = self.row(state_at)[column]
+            if state_at == -1:
+                return False
+        return self.is_target(state_at)
+
+    def shortest_string(self):
+        # Returns the shortest accepted string (first in alphabetical order), or None if there is none
+        # It searches breadth-first and stops at the first target state
+        if self.is_target(self.start_state):
+            return ''
+
+        # One character per class is enough to reach every state
+        representative = {}
+        for char in self.alphabet:
+            representative.setdefault(self.char_index[char],char)
+        chars = [(representative[c],c) for c in sorted(representative,key=lambda c:representative[c])]
+
+        self.dfa1.compute_dead_states()
+        self.dfa2.compute_dead_states()
+        parent = {self.start_state:None}
+        frontier = [self.start_state]
+        while len(frontier) != 0:
+            next_frontier = []
+            for state in frontier:
+                row = self.row(state)
+                for char, c in chars:
+                    se = row[c]
+                    if se == -1 or se in parent:
+                        continue
+                    parent[se] = (state,char)
+                    if self.is_target(se):
+                        # Walk back to the start to build the string
+                        string = ""
+                        while parent[se] is not None:
+                            se, char = parent[se]
+                            string = char+string
+                        return string
+                    if not self.is_dead(se):
+                        next_frontier.append(se)
+            frontier = next_frontier
+        return None
+
+    def is_empty(self):
+        # Returns whether the combination accepts no string at all
+        return self.shortest_string() is None
+
+    def strings(self, max_len = None):
+        # Generates the accepted strings in order of length, and alphabetically for the same length
+        # Without a maximum length it has to know exactly which states are dead to ever stop,
+        # so in that case the whole product is found first
+        self.dfa1.compute_dead_states()
+        self.dfa2.compute_dead_states()
+        is_dead = self.is_dead
+        if max_len is None:
+            product = self.materialize()
+            product.compute_dead_states()
+            is_dead = lambda state : state == -1 or state in product.dead_states
+        frontier = [("",self.start_state)]
+        length = 0
+        while len(frontier) != 0 and (max_len is None or length <= max_len):
+            next_frontier = []
+            for string, state in frontier:
+                if self.is_target(state):
+                    yield string
+                if max_len is not None and length == max_len:
+                    continue
+                row = self.row(state)
+                for char in self.alphabet:
+                    se = row[self.char_index[char]]
+                    if not is_dead(se):
+                        next_frontier.append((string+char,se))
+            frontier = next_frontier
+            length += 1
+
+    def materialize(self):
+        # Finds all the remaining states and creates the product dfa
+        # The sink of the product stays implicit, so the new dfa can be partial
+
+        # The table of the new dfa is filled one row at a time, in the order of the states
+        new_table = array('i')
+        at = 0
+        while at < len(self.states):
+            new_table.extend(self.row(at))
+            at += 1
+
+        # After that's done you have all the new states and edges, so create the new dfa
+        new_dfa = DFA(self.alphabet)
+        new_dfa.set_table(new_table,len(self.states),dict(self.char_index))
+        for i in range(new_dfa.num_states):
+            new_dfa.set_state_target(i,self.is_target(i))
+        return new_dfa
+
+def lazy_combine_DFA(dfa1:DFA,dfa2:DFA,mode):
+    # Like combine_DFA, but the product is only explored when it is used
+
+    # DFA's must have the same alphabet
+    if dfa1.alphabet != dfa2.alphabet:
+        print("Tried to combine dfa's with different alphabet")
+        return
+    return LazyProductDFA(dfa1,dfa2,mode)
 
 def combine_DFA(dfa1:DFA,dfa2:DFA,mode):
     # Combines two dfa's to create combinations
     # Mode determines which states are considered final in the combination
-    # Different mode values produce &, |, - and other useful functions
+    # Different mode values produce &, |, -, ^ (symmetric difference) and other useful functions
 
     # DFA's must have the same alphabet
     if dfa1.alphabet != dfa2.alphabet:
         print("Tried to combine dfa's with different alphabet")
         return
-    alphabet = dfa1.alphabet.copy()
-
-    # The operation requires dfa's to be complete
-    for dfa in (dfa1,dfa2):
-        if not dfa.is_complete():
-            dfa.make_complete()
-
-    # Create a list for the new states, and for the pending ones
-    new_states = []
-    pending = []
-    
-    # Create dictionary for the new state edges
-    new_state_edges = {}
-
-    # Create the first state and add it to the pending
-    pending.append((0,0))
-
-    # Do the loop to produce the new dfa
-    while True:
-
-        # Check if you are done
-        if len(pending) == 0:
-            break
-
-        # Get the next pending state
-        state_at = pending.pop()
-        if state_at in new_state_edges:
-            continue
 
-        # Add the state to the list and to the edges dictionary
-        new_states.append(state_at)
-        new_state_edges[state_at] = {}
-
-        # Find all the edges of that state
-        for char in alphabet:
-
-            # Find the new state for the character
-            state_next = (dfa1.edges[state_at[0]][char],dfa2.edges[state_at[1]][char])
-
-            # Add it to the pending states
-            pending.append(state_next)
-
-            # Fill in the specific edge
-            new_state_edges[state_at][char] = state_next
-
-    # After that's done you have all the new states for the new dfa,
-    # in an arbitrary order in new_states (but the start state is always the first one)
-    # and you also have all the edges, so create the new dfa
-    new_dfa = DFA(alphabet)
-
-    # Add as many states as you need (the first one is already present)
-    for i in range(len(new_states)-1):
-        new_dfa.add_state()
-    
-    # Create a dictionary to enumerate the various states
-    state_map = { s:i for i,s in enumerate(new_states)}
-
-    # Fill in all the edges
-    for state in new_states:
-        # Find the state representation
-        ds = state_map[state]
-        # Fill in the edges for that one
-        for char in new_state_edges[state]:
-            # Find the corresponding representation
-            cs = state_map[new_state_edges[state][char]]
-            # Add the new edge to your new dfa
-            new_dfa.add_edge(ds,cs,char)
-
-    # Finally, according to the mode, map which states are final, and which are not
-    # We do that by mapping the right function
-    is_target = {
-        '|': lambda x : x[0] in dfa1.target_states or x[1] in dfa2.target_states,
-        '&': lambda x : x[0] in dfa1.target_states and x[1] in dfa2.target_states,
-        '-': lambda x : x[0] in dfa1.target_states and x[1] not in dfa2.target_states,
-    }[mode]
-    for i in range(new_dfa.num_states):
-        new_dfa.set_state_target(i,is_target(new_states[i]))
-
-    # Finally, return the new dfa
-    return new_dfa
+    # Build the whole product at once
+    return LazyProductDFA(dfa1,dfa2,mode).materialize()
 
 def concat_DFA(dfa1:DFA, dfa2:DFA):
-    return concat_NFA(dfa1.extract_nfa(),dfa2.extract_nfa()).extract_dfa()
+    return concat_NFA(dfa1.extract_nfa(),dfa2.extract_nfa()).extract_dfa(dfa1.alphabet)
 
 def kleene_DFA(dfa1:DFA):
     # Produces the kleene star of the given dfa
-    return kleene_NFA(dfa1.extract_nfa()).extract_dfa()
+    return kleene_NFA(dfa1.extract_nfa()).extract_dfa(dfa1.alphabet)
 
 def base_DFA(string:str, alphabet):
 
     # Makes a dfa that recognises a specific string
-    res =  base_NFA(string).extract_dfa()
-    res.alphabet = alphabet
-    res.make_complete()
-    return res
+    return base_NFA(string).extract_dfa(alphabet)
 
 # Purpose specific DFA's
 
@@ -695,7 +1989,11 @@ def digify_DFA(dfa:DFA):
     while True:
         # Visit the next state in order
         order_at += 1
-        state_at, tar = dfa.find_state(state_at,char)
+        # A missing edge leads to the implicit sink, which is a non target state that loops on itself
+        if state_at != -1 and char in dfa.edges[state_at]:
+            state_at, tar = dfa.find_state(state_at,char)
+        else:
+            state_at, tar = (-1, False)
 
         # Check if you have visited the state before, and you are done
         if state_at in mapping:
@@ -1,4 +1,4 @@
-
+from array import array
 
 class NFA:
     # Representation of a NFA
@@ -18,6 +18,12 @@ class NFA:
         self.edges = {
             0:[]
         }
+
+        # The states every state reaches with empty edges only, as bitsets (see compute_closures)
+        # and the states every state reaches with each character (see compute_index)
+        # They are computed once when they are needed, and forgotten after every change
+        self.closures = None
+        self.moves = None
         
     def print_info(self):
         # Prints the whole of the nfa
@@ -40,6 +46,8 @@ class NFA:
             
         # Add new entry to the edges
         self.edges[new_state] = []
+        self.closures = None
+        self.moves = None
         
         return new_state
     
@@ -73,6 +81,8 @@ class NFA:
             
     def reset_edges(self):
         # This will drop all the edges of the automaton
+        self.closures = None
+        self.moves = None
         self.edges = {}
         for i in range(self.num_states):
             self.edges[i] = []
@@ -86,12 +96,16 @@ class NFA:
             return
         
         self.edges[ss].append((se,string))
+        self.closures = None
+        self.moves = None
           
     def simplify(self):
         # This will break up rules that consist of more than one characters
         # It will produce states as it goes
         
         # Get the old edges end drop them
+        self.closures = None
+        self.moves = None
         old_edges = self.edges.copy()
         self.reset_edges()
         
@@ -127,147 +141,228 @@ class NFA:
                 
     def derive_alphabet(self):
         
-        # Runs through the edge list, and finds the characters of the alphabet
+        # The characters of the alphabet are the ones in the index
         alphabet = set()
-        for state in self.edges:
-            for edge in self.edges[state]:
-                for char in edge[1]:
-                    alphabet.add(char)
+        for moves in self.compute_index():
+            alphabet.update(moves)
         
         # Return the alphabet
         return alphabet
     
     # Below are some functions that help turn the NFA into a DFA
+    def compute_closures(self):
+        # Finds the states that every state reaches with empty edges only, all at once
+        # The states that reach each other with empty edges are found with Tarjan's strongly
+        # connected components. They all have the same closure, and the components come out
+        # in reverse topological order, so the closures of the components they lead to are
+        # always ready before them. Every closure is a bitset, with a bit for every state
+        if self.closures is not None:
+            return self.closures
+
+        empty = [[e[0] for e in self.edges[state] if e[1] == ''] for state in range(self.num_states)]
+        closures = [0]*self.num_states
+        index = [-1]*self.num_states
+        low = [0]*self.num_states
+        on_stack = [False]*self.num_states
+        stack = []
+        counter = 0
+        for root in range(self.num_states):
+            if index[root] != -1:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root,iter(empty[root]))]
+            while len(work) != 0:
+                state_at, neighbors = work[-1]
+                advanced = False
+                for neighbor in neighbors:
+                    if index[neighbor] == -1:
+                        index[neighbor] = low[neighbor] = counter
+                        counter += 1
+                        stack.append(neighbor)
+                        on_stack[neighbor] = True
+                        work.append((neighbor,iter(empty[neighbor])))
+                        advanced = True
+                        break
+                    if on_stack[neighbor]:
+                        low[state_at] = min(low[state_at],index[neighbor])
+                if advanced:
+                    continue
+
+                # You are done with this state, check if it closes a component
+                work.pop()
+                if len(work) != 0:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent],low[state_at])
+                if low[state_at] == index[state_at]:
+                    component = []
+                    while True:
+                        s = stack.pop()
+                        on_stack[s] = False
+                        component.append(s)
+                        if s == state_at:
+                            break
+
+                    # The closure of the component is its states and the closures it leads to
+                    # (the states of the component itself have no closure yet, so they add nothing)
+                    closure = 0
+                    for s in component:
+                        closure |= 1 << s
+                    for s in component:
+                        for se in empty[s]:
+                            closure |= closures[se]
+                    for s in component:
+                        closures[s] = closure
+
+        self.closures = closures
+        return closures
+
+    def compute_index(self):
+        # Finds, for every state and character, the states that are reached by reading the character
+        # The index is a list with a dictionary for every state, that maps each of its characters
+        # to a bitset of the states, closures included. Empty edges are only kept in the closures
+        # Edges of more than one character are split first (see simplify)
+        if self.moves is not None:
+            return self.moves
+        if any(len(e[1]) > 1 for state in self.edges for e in self.edges[state]):
+            self.simplify()
+
+        closures = self.compute_closures()
+        moves = []
+        for state in range(self.num_states):
+            state_moves = {}
+            for e in self.edges[state]:
+                if e[1] != '':
+                    state_moves[e[1]] = state_moves.get(e[1],0) | closures[e[0]]
+            moves.append(state_moves)
+
+        self.moves = moves
+        return moves
+
+    def states_of(self, bits):
+        # Turns a bitset of states into a set of states
+        states = set()
+        while bits:
+            low = bits & -bits
+            states.add(low.bit_length()-1)
+            bits ^= low
+        return states
+
     def instant_states(self,state):
         # This will return a set of all the states that are reachable from the supplied, with specific input character
-        
-        marked = set()
-        tovisit = [state]
-        
-        # Begin the search
-        while True:
-            
-            # If you don't have more you are done
-            if len(tovisit) == 0:
-                break
-            
-            # Take a pending state and check that it's not yet marked
-            state_at = tovisit.pop()
-            if state_at in marked:
-                continue
-            marked.add(state_at)
-            
-            # Mark it and find all the legit visitors
-            for e in self.edges[state_at]:
-                if e[1] == '':
-                    tovisit.append(e[0])
-        
-        # After you finish, return all that were marked
-        return marked
+        return self.states_of(self.compute_closures()[state])
     
     def char_states(self, state_set, char):
         # This will return a set of states that are reachable by any of the states
         # in the provided set by use of one character
         # It is assumed that the provided states are inclusive of the instant states
+        moves = self.compute_index()
         
-        # The set to store all the results
-        result = set()
-        
-        # Loop through all the states in the set
+        # Gather the states that every state reaches with the char
+        result = 0
         for state in state_set:
-            
-            # Find all the states that you can access with the char
-            access_states = set()
-            for e in self.edges[state]:
-                if e[1] == char:
-                    access_states.add(e[0])
-            
-            # For all the states you found, try the instant_state and add the result to the end states
-            for s in access_states:
-                result.update(self.instant_states(s))
+            result |= moves[state].get(char,0)
         
+        return self.states_of(result)
+
+    def target_bits(self):
+        # Returns the target states as a bitset
+        targets = 0
+        for s in self.target_states:
+            targets |= 1 << s
+        return targets
+
+    def step(self, states, char):
+        # Returns the bitset of the states reached from a bitset of states with one character
+        moves = self.compute_index()
+        result = 0
+        while states:
+            low = states & -states
+            result |= moves[low.bit_length()-1].get(char,0)
+            states ^= low
         return result
-                
-    def extract_dfa(self):
+
+    def check_string(self, string):
+        # Checks if a string is accepted, by following all the states the nfa can be in at once
+        # This takes O(len(string)*states) time, and nothing is determinized, so it is the safe
+        # choice for a single check against a pattern whose dfa would be huge
+        states = self.compute_closures()[self.start_state]
+        for char in string:
+            states = self.step(states,char)
+            # No state is left, so nothing that comes next can be accepted
+            if states == 0:
+                return False
+        return states & self.target_bits() != 0
+
+    def matcher(self, block_size = 1<<16):
+        # Returns a new matcher that checks a string that is given in chunks (see DFAMatcher)
+        from dfa import NFAMatcher
+        return NFAMatcher(self,block_size)
+
+    def lazy_dfa(self, max_states = 4096):
+        # Returns a dfa of this nfa that is only determinized while it is used, keeping at most
+        # max_states states (see LazyDFA)
+        from dfa import LazyDFA
+        return LazyDFA(self,max_states)
+
+    def extract_dfa(self, alphabet = None):
         
         from dfa import DFA
         # This function will extract a DFA from this NFA
-        # Make sure to call simplify first
-        
-        # First we need to figure out the alphabet
-        alphabet = self.derive_alphabet()
-        
-        # The following function will turn state sets into tupples that are hashable
-        def tuple_from_states(states):
-            ls = list(states)
-            ls.sort()
-            return tuple(ls)
-        
-        # Then I need to create a dictionary with all the new states
-        # The dictionary will contain tupples with old states
-        dfa_states = {}
-        
-        # I need to process all the states in that list
-        start_state = tuple_from_states(self.instant_states(self.start_state))
-        pending = [start_state]
-        visited = set() # This will mark those that are already processed
-        
-        while True:
-            
-            # Check if you are done
-            if len(pending) == 0:
-                break
-            
-            # Put out the next state you will be visiting
-            state_at = pending.pop()
-            
-            # Check if you have seen this one already
-            if state_at in visited:
-                continue
+        # The empty set of states is left out, its edges go to the implicit sink of the dfa
+        # Every state of the dfa is a set of states of the nfa, which is kept as a bitset, so
+        # finding the next set is a union of the bitsets of the index (see compute_index)
+        
+        # First we need to figure out the alphabet, if it is not given
+        moves = self.compute_index()
+        closures = self.compute_closures()
+        if alphabet is None:
+            alphabet = self.derive_alphabet()
+        mydfa = DFA(alphabet)
+        column = {char:i for i,char in enumerate(mydfa.alphabet)}
+        cols = len(mydfa.alphabet)
 
-            visited.add(state_at)
+        # The targets as a bitset too
+        targets = 0
+        for s in self.target_states:
+            targets |= 1 << s
+        
+        # Number the sets in the order they are found, the start set is 0
+        start_set = closures[self.start_state]
+        mapping = {start_set:0}
+        order = [start_set]
+        table = array('i')
+        at = 0
+        while at < len(order):
             
-            # Add it to the dictionary
-            dfa_states[state_at] = {}
-            
-            # Do all the possible paths
-            for char in alphabet:
-                
-                # Find the state for this character
-                next_state = tuple_from_states(self.char_states(set(state_at),char))
-
-                # Add it to the pending and to the dictionary
-                dfa_states[state_at][char] = next_state
-                pending.append(next_state)
+            # Find the next set for every character at once, walking the states of the set once
+            next_sets = {}
+            bits = order[at]
+            while bits:
+                low = bits & -bits
+                for char, reached in moves[low.bit_length()-1].items():
+                    next_sets[char] = next_sets.get(char,0) | reached
+                bits ^= low
 
-        # After you finish, create a mapping between the states and numbers
-        at = 1
-        mapping = {}
-        for state in dfa_states:
-            if state == start_state:
-                mapping[state] = 0
-                continue
-            mapping[state] = at
+            # Then fill the row, giving a number to the new sets
+            row = array('i',[-1])*cols
+            for char, next_set in next_sets.items():
+                if char not in column:
+                    continue
+                if next_set not in mapping:
+                    mapping[next_set] = len(order)
+                    order.append(next_set)
+                row[column[char]] = mapping[next_set]
+            table.extend(row)
             at += 1
-        
-        # Then create the dfa
-        mydfa = DFA(alphabet)
-        
-        # Create for the dfa as many states as you must
-        for i in range(len(dfa_states)-1):
-            mydfa.add_state()         
 
-        # Add all the edges that you found
-        for state in dfa_states:
-            d_state = mapping[state]
-            for char in dfa_states[state]:
-                mydfa.add_edge(d_state,mapping[dfa_states[state][char]],char)
-        
-        # Finally, make the targets state correct
-        for state in dfa_states:
-            for s in state:                
-                if s in self.target_states:
-                    mydfa.set_state_target(mapping[state],True)
+        # Then create the dfa, and make the targets state correct
+        mydfa.set_table(table,len(order))
+        for i, states in enumerate(order):
+            if states & targets:
+                mydfa.set_state_target(i,True)
                     
         # You are done, return the DFA
         return mydfa
@@ -1,13 +1,209 @@
 # This is the second attempt at a parser, with more advanced features such as more set operations
 # and specific number of repeats for star
 
-from dfa import DFA, digify_DFA, kleene_DFA, base_DFA, combine_DFA, concat_DFA, modulo_DFA
-import copy
+from dfa import DFA, digify_DFA, base_DFA, combine_DFA, modulo_DFA, FORMAT_VERSION
+from nfa import NFA, concat_NFA, kleene_NFA, union_NFA
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import time
+import tracemalloc
+
+class CompileCache:
+    # This keeps the dfa's of patterns that were already parsed, so they are not parsed again
+    # The most recently used ones are kept in memory, and if a directory is given they are
+    # also saved there, so that other processes (or later runs) can load them
+    # The cached dfa's are frozen, so nobody can alter them by mistake
+
+    def __init__(self, size=128, directory=None):
+
+        # How many dfa's are kept in memory, and where they are saved
+        self.size = size
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory,exist_ok=True)
+        self.entries = OrderedDict()
+
+        # Statistics of how useful the cache is
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def path_for(self, key):
+        # The file of a key is named after its hash and the format version
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory,digest+".v"+str(FORMAT_VERSION)+".dfa")
+
+    def get(self, key):
+        # Returns the cached dfa of the key, or None if there is none
+
+        # Check the memory first
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        # Then check the directory
+        if self.directory is not None:
+            path = self.path_for(key)
+            if os.path.exists(path):
+                try:
+                    dfa = DFA.load(path)
+                except Exception:
+                    dfa = None
+                if dfa is not None:
+                    self.disk_hits += 1
+                    self.remember(key,dfa)
+                    return dfa
+
+        self.misses += 1
+        return None
+
+    def put(self, key, dfa:DFA):
+        # Stores a dfa in the cache, it is frozen if it wasn't already
+        dfa.freeze()
+        self.remember(key,dfa)
+        if self.directory is not None:
+            # Write to a temporary file first, so nobody loads a half written file
+            path = self.path_for(key)
+            temp = path+"."+str(os.getpid())+".tmp"
+            dfa.save(temp)
+            os.replace(temp,path)
+
+    def remember(self, key, dfa:DFA):
+        # Keeps the dfa in memory, and forgets the least recently used ones if there are too many
+        self.entries[key] = dfa
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        # Forgets everything that is kept in memory
+        self.entries.clear()
+
+    def stats(self):
+        # Returns the statistics of the cache
+        return {'hits':self.hits, 'disk_hits':self.disk_hits, 'misses':self.misses, 'size':len(self.entries)}
+
+class CompileTrace:
+    # This records how a pattern was parsed, so slow patterns can be analysed later
+    # It is a tree with a node for every grammar rule the parser went through, and a node for
+    # every operation on the automata (combine_DFA, concat_DFA, kleene_DFA, extract_dfa, ...)
+    # Every node has its wall time, and operations have the number of states of their inputs
+    # and output. With memory, the peak of the traced memory is recorded for every node too,
+    # which makes the parsing a lot slower
+
+    def __init__(self, pattern:str, memory=False):
+        self.memory = memory
+        self.root = {'node':'parse', 'pattern':pattern, 'children':[]}
+        self.stack = []
+        self.started_memory = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_memory = True
+        self.open(self.root)
+
+    def open(self, node):
+        # Starts a node as a child of the current one
+        if len(self.stack) != 0:
+            self.stack[-1]['children'].append(node)
+        if self.memory:
+            # The peak so far belongs to the parent, the child starts counting from now
+            if len(self.stack) != 0:
+                parent = self.stack[-1]
+                parent['peak_memory'] = max(parent.get('peak_memory',0),tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        node['time'] = time.perf_counter()
+        self.stack.append(node)
+
+    def close(self):
+        # Ends the current node
+        node = self.stack.pop()
+        node['time'] = time.perf_counter()-node['time']
+        if self.memory:
+            node['peak_memory'] = max(node.get('peak_memory',0),tracemalloc.get_traced_memory()[1])
+            if len(self.stack) != 0:
+                parent = self.stack[-1]
+                parent['peak_memory'] = max(parent.get('peak_memory',0),node['peak_memory'])
+            tracemalloc.reset_peak()
+        return node
+
+    def enter(self, rule:str, position:int):
+        # Starts the node of a grammar rule at the given position of the pattern
+        self.open({'node':rule, 'start':position, 'children':[]})
+
+    def exit(self, position:int):
+        # Ends the node of the current grammar rule
+        self.close()['end'] = position
+
+    def note(self, key:str, value):
+        # Adds some information to the current node
+        self.stack[-1][key] = value
+
+    def operation(self, name:str, function, args):
+        # Runs an operation on automata, recording its inputs and output
+        # The automaton of a method is an input as well
+        inputs = [getattr(function,'__self__',None)]+list(args)
+        node = {'operation':name, 'input_states':[arg.num_states for arg in inputs if hasattr(arg,'num_states')], 'children':[]}
+        self.open(node)
+        try:
+            result = function(*args)
+        finally:
+            self.close()
+        if hasattr(result,'num_states'):
+            node['output_states'] = result.num_states
+        return result
+
+    def finish(self, error=None):
+        # Ends all the nodes that are still open, they are left open by an error
+        while len(self.stack) != 0:
+            node = self.stack[-1]
+            if error is not None:
+                node['error'] = error
+            self.close()
+        if self.started_memory:
+            tracemalloc.stop()
+            self.started_memory = False
+
+    def to_dict(self):
+        return self.root
+
+    def to_json(self, indent=None):
+        return json.dumps(self.root,indent=indent)
+
+    def save(self, path):
+        with open(path,'w') as f:
+            f.write(self.to_json(indent=1))
 
 class RegexpParser:
     # This class reads strings containing regexp, and outputs the dfa.
 
-    def __init__(self):
+    def __init__(self, minimize=False, cache=None, trace=False, trace_memory=False):
+
+        # Whether the intermediate dfa's are minimized after every combination step
+        self.minimize = minimize
+
+        # Whether every parse is traced (see CompileTrace), the trace of the last one is kept
+        self.trace = trace or trace_memory
+        self.trace_memory = trace_memory
+        self.tracer = None
+        self.last_trace = None
+
+        # A cache of the patterns that were already parsed (see CompileCache)
+        # With a cache, the dfa's that are returned are frozen
+        self.cache = cache
+
+        # The dfa's of the terms already parsed in the current string, by their source text,
+        # so that a term that repeats is only built once
+        self.term_memo = {}
+
+        # The dfa's of single characters and character classes, by the character and the alphabet
+        # These are kept between strings, and they are frozen since they are shared
+        self.char_memo = {}
+
+        # Whether the current string is parsed to an nfa instead of a dfa (see parse)
+        self.build_nfa = False
 
         # The string you are parsing
         self.string = ""
@@ -110,13 +306,52 @@ class RegexpParser:
         self.alphabet.sort()
         # You found all the alphabet, time to parse!
 
-    def parse_string(self,string:str,debug=False):
+    def parse_string(self,string:str,debug=False,nfa=False):
         # This will parse a string
+        # If the string is not valid, the error is printed and None is returned
+
+        try:
+            return self.parse(string,debug,nfa)
+        except Exception as e:
+            print(e)
+            return None
+
+    def parse(self,string:str,debug=False,nfa=False):
+        # This will parse a string, like parse_string, but errors are raised
+        # With nfa, an nfa is returned instead of a dfa, and it is only determinized where the
+        # operations need it (~, & and -), so patterns with a huge dfa can still be checked
+        # with NFA.check_string. The nfa's are not cached
+        
+        # Start the trace
+        self.tracer = CompileTrace(string,self.trace_memory) if self.trace else None
+        self.last_trace = self.tracer
+        self.build_nfa = nfa
+        try:
+            return self.parse_traced(string,debug)
+        except Exception as e:
+            if self.tracer is not None:
+                self.tracer.finish(str(e) or type(e).__name__)
+            raise
+        finally:
+            if self.tracer is not None:
+                self.tracer.finish()
+            self.tracer = None
+
+    def parse_traced(self,string:str,debug):
         
         # Parse the alphabet first
         self.find_alphabet(string)
         self.debug = debug
 
+        # Check if the pattern is already parsed
+        if self.cache is not None and not self.build_nfa:
+            key = (string, tuple(self.alphabet), self.minimize)
+            cached = self.cache.get(key)
+            if self.tracer is not None:
+                self.tracer.note('cache_hit',cached is not None)
+            if cached is not None:
+                return cached
+
         # Initiate the parser
         self.string = string
         self.string_at = 0
@@ -125,12 +360,69 @@ class RegexpParser:
         # Get the first character
         self.consume_char()
         
+        self.term_memo = {}
         try:
-            return self.expr()
-        except Exception as e:
-            print(e)
+            result = self.expr()
+        finally:
+            self.term_memo = {}
+
+        # Keep the result for the next time
+        if self.build_nfa:
+            result = self.as_nfa(result)
+        elif self.cache is not None:
+            self.cache.put(key,result)
+        elif result.frozen:
+            # The result is a shared one, give back a copy that can be altered
+            result = result.copy()
+        return result
+
+    def term_end(self, start:int):
+        # Finds where the term that starts at the given position ends, by looking ahead
+        # in the string: either a character or a group in parentheses, and then its star
+        # Returns None if the term doesn't look complete, so it will just be parsed
+        s = self.string
+        i = start
+        if i >= len(s):
+            return None
+        if s[i] == '(':
+            depth = 0
+            while i < len(s):
+                if s[i] == '\\':
+                    i += 2
+                    continue
+                if s[i] == '(':
+                    depth += 1
+                elif s[i] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            if depth != 0:
+                return None
+            i += 1
+        elif s[i] == '\\':
+            i += 2
+        else:
+            i += 1
+
+        # Then the star
+        if i < len(s) and s[i] == '*':
+            i += 1
+        elif i < len(s) and s[i] == '^':
+            i += 1
+            if i < len(s) and s[i] == '[':
+                i = s.find(']',i)
+                if i == -1:
+                    return None
+                i += 1
+            else:
+                while i < len(s) and s[i].isdigit():
+                    i += 1
+        return i
 
-        pass
+    def position(self):
+        # Returns where the current character starts in the string
+        return self.string_at-len(self.char_at)
 
     
 
@@ -141,13 +433,74 @@ class RegexpParser:
         raise Exception("Unexpected symbol '"+self.char_at+"' while parsing "+parsed) 
     
     def report_progress(self,at:str):
+        # Called when a grammar rule starts, it opens its node in the trace
+        if self.tracer is not None:
+            self.tracer.enter(at,self.position())
         if self.debug:
             print("Entering "+at+" with",self.string[:self.string_at-1],"{"+self.char_at+"}",self.string[self.string_at:])
 
     def report_exit(self,at:str):
+        # Called when a grammar rule ends, it closes its node in the trace
+        if self.tracer is not None:
+            self.tracer.exit(self.position())
         if self.debug:
             print("Exiting "+at+" with",self.string[:self.string_at-1],"{"+self.char_at+"}",self.string[self.string_at:])
 
+    def traced(self, name:str, function, *args):
+        # Runs an operation on automata, and records it if the parse is traced
+        if self.tracer is None:
+            return function(*args)
+        return self.tracer.operation(name,function,args)
+
+    def concat_dfa(self, dfa1:DFA, dfa2:DFA):
+        # Like concat_DFA, but the extraction of the dfa is traced on its own
+        nfa = concat_NFA(dfa1.extract_nfa(),dfa2.extract_nfa())
+        return self.traced('extract_dfa',nfa.extract_dfa,dfa1.alphabet)
+
+    def kleene_dfa(self, dfa:DFA):
+        # Like kleene_DFA, but the extraction of the dfa is traced on its own
+        nfa = kleene_NFA(dfa.extract_nfa())
+        return self.traced('extract_dfa',nfa.extract_dfa,dfa.alphabet)
+
+    def as_dfa(self, automaton):
+        # Determinizes an nfa of the nfa mode, for the operations that need a dfa
+        if isinstance(automaton,NFA):
+            return self.reduce(self.traced('extract_dfa',automaton.extract_dfa,self.alphabet))
+        return automaton
+
+    def as_nfa(self, automaton):
+        # Turns a dfa into an nfa, for the nfa mode
+        if isinstance(automaton,DFA):
+            return self.traced('extract_nfa',automaton.extract_nfa)
+        return automaton
+
+    # The operations of the grammar, in the nfa mode concatenation, union and star stay on nfa's
+
+    def concat(self, first, second):
+        if self.build_nfa:
+            return self.traced('concat_NFA',concat_NFA,self.as_nfa(first),self.as_nfa(second))
+        return self.reduce(self.traced('concat_DFA',self.concat_dfa,first,second))
+
+    def union(self, first, second):
+        if self.build_nfa:
+            return self.traced('union_NFA',union_NFA,self.as_nfa(first),self.as_nfa(second))
+        return self.combine(first,second,'|')
+
+    def kleene(self, automaton):
+        if self.build_nfa:
+            return self.traced('kleene_NFA',kleene_NFA,self.as_nfa(automaton))
+        return self.reduce(self.traced('kleene_DFA',self.kleene_dfa,automaton))
+
+    def combine(self, first, second, op):
+        return self.reduce(self.traced('combine_DFA',combine_DFA,self.as_dfa(first),self.as_dfa(second),op))
+
+    def reduce(self,dfa:DFA):
+        # Minimizes an intermediate dfa if the parser is set to do so
+        # This keeps the products of the next combinations small
+        if self.minimize and isinstance(dfa,DFA):
+            return self.traced('minimize',dfa.minimize)
+        return dfa
+
 
     def expr(self):
         self.report_progress('expr')
@@ -178,7 +531,9 @@ class RegexpParser:
 
             # Combine with the previous and return it
             self.report_exit('restexpr')
-            return combine_DFA(prev,expr,op)
+            if op == '|':
+                return self.union(prev,expr)
+            return self.combine(prev,expr,op)
 
         elif self.char_at in {')', ''}:
 
@@ -218,7 +573,7 @@ class RegexpParser:
         else:
             # Parse and combine with the previous
             term = self.term()
-            res = self.termlist(concat_DFA(prev,term))
+            res = self.termlist(self.concat(prev,term))
             self.report_exit('termlist')
             return res
 
@@ -235,8 +590,9 @@ class RegexpParser:
         restterm = self.restterm()
 
         # Negate if there is negation, and return
+        # The dfa may be shared, so it is not negated in place
         if neg:
-            restterm.negate()
+            restterm = self.traced('negated',self.as_dfa(restterm).negated)
         self.report_exit('term')
         return restterm
 
@@ -248,6 +604,17 @@ class RegexpParser:
         if self.char_at in self.key_symbols-{'('}:
             self.throw_unexpected('restterm')
 
+        # Check if the same term was already parsed, then just skip it
+        term_start = self.position()
+        term_end = self.term_end(term_start)
+        if term_end is not None and self.string[term_start:term_end] in self.term_memo:
+            self.string_at = term_end
+            self.consume_char()
+            if self.tracer is not None:
+                self.tracer.note('memo_hit',True)
+            self.report_exit('restterm')
+            return self.term_memo[self.string[term_start:term_end]]
+
         # Check if you have complex expression
         if self.char_at == '(':
             self.consume_char()
@@ -259,14 +626,28 @@ class RegexpParser:
             # You have a list of characters, create the new dfa
             
             # Get the list of characters
+            char_key = (self.char_at, tuple(self.alphabet), self.minimize)
             char_list = self.get_special_chars(self.char_at)
             self.consume_char()
 
-            # Create the union DFA from those characters
-            expr = base_DFA(char_list[0],self.alphabet)
-            for char in char_list[1:]:
-                temp = base_DFA(char,self.alphabet)
-                expr = combine_DFA(expr,temp,'|')
+            # Create the union DFA from those characters, unless it is already made
+            # In the nfa mode an nfa with an edge for every character is made instead
+            if self.build_nfa:
+                expr = NFA()
+                expr.add_state(True)
+                for char in char_list:
+                    expr.add_edge(0,1,char)
+            elif char_key in self.char_memo:
+                expr = self.char_memo[char_key]
+                if self.tracer is not None:
+                    self.tracer.note('memo_hit',True)
+            else:
+                expr = self.traced('base_DFA',base_DFA,char_list[0],self.alphabet)
+                for char in char_list[1:]:
+                    temp = self.traced('base_DFA',base_DFA,char,self.alphabet)
+                    expr = self.traced('combine_DFA',combine_DFA,expr,temp,'|')
+                expr = self.reduce(expr).freeze()
+                self.char_memo[char_key] = expr
         
         # Finally parse the star
         star = self.star()
@@ -274,38 +655,39 @@ class RegexpParser:
         # Check the star cases
         if type(star) == bool and star:
             # Add kleene star to the mix
-            expr = kleene_DFA(expr)
+            expr = self.kleene(expr)
         elif type(star) in {int,tuple}:
-            # Find the start and the end
+            # Find the lowest and the highest number of repetitions
             if type(star) == int:
-                start, end = (star, star)
+                low, high = (star, star)
             else:
-                start, end = (star[0],star[1])
+                low, high = (star[0],star[1])
 
             # Repeat for every repetition number
             final = None
-            for r in range(start,end+1):
+            for r in range(low,high+1):
                 # R is the number of repetitions,
                 # construct a DFA with this number of repetitions
                 if r == 0:
                     # Special case for the zero repetitions
-                    temp = DFA(self.alphabet)
-                    temp.make_complete()
+                    temp = NFA() if self.build_nfa else DFA(self.alphabet)
                 else:
-                    temp = copy.deepcopy(expr)
+                    # Nfa's are never altered, so they don't need a copy
+                    temp = expr if isinstance(expr,NFA) else expr.copy()
                     for i in range(r-1):
-                        temp = concat_DFA(temp,expr)
+                        temp = self.concat(temp,expr)
 
                 # Add to the final
                 if not final:
                     final = temp
                 else:
-                    final = combine_DFA(final,temp,'|')
+                    final = self.union(final,temp)
 
             # Set the expr to be the final
             expr = final
 
-        # After all the parsing, return the expr
+        # After all the parsing, remember the term and return the expr
+        self.term_memo[self.string[term_start:self.position()]] = expr
         self.report_exit('restterm')
         return expr
 
@@ -392,7 +774,9 @@ class RegexpParser:
         # Convert the digit and pass it to the rest of the number
         dchar = self.char_at
         self.consume_char()
-        return self.restnum(ord(dchar)-ord('0'))
+        res = self.restnum(ord(dchar)-ord('0'))
+        self.report_exit('actualnum')
+        return res
     
     def restnum(self,prev):
         self.report_progress('restnum')
@@ -403,15 +787,51 @@ class RegexpParser:
             # Parse the rest
             dchar = self.char_at
             self.consume_char()
-            return self.restnum(prev*10+(ord(dchar)-ord('0')))
+            res = self.restnum(prev*10+(ord(dchar)-ord('0')))
+            self.report_exit('restnum')
+            return res
 
         # If you don't have a digit, check that you have a valid character
         if self.char_at in self.key_symbols-{'(', '|', ']', '~', '', ')', '-', '&'}:
             self.throw_unexpected('restnum')
         
         # If you don't have anything else, return the previous one
+        self.report_exit('restnum')
         return prev
 
+def compile_to_bytes(pattern:str, minimize=False):
+    # Parses a single pattern and returns a pair of its dfa in the binary format and the error
+    # This is what the workers of compile_many run, the bytes are much cheaper to send back
+    try:
+        return (RegexpParser(minimize).parse(pattern).to_bytes(), None)
+    except Exception as e:
+        return (None, str(e) or type(e).__name__)
+
+def compile_many(patterns, workers=None, minimize=False):
+    # Parses many independent patterns at once, spread over a pool of processes
+    # Returns a list of (pattern, dfa, error) in the order of the patterns, where the dfa is None
+    # if the pattern had an error. A bad pattern doesn't stop the rest
+    # The dfa's are frozen, and their tables are read directly from the bytes the workers sent
+    patterns = list(patterns)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # With a single worker there is no need for other processes
+    if workers <= 1 or len(patterns) <= 1:
+        results = [compile_to_bytes(p,minimize) for p in patterns]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1,len(patterns)//(workers*4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(compile_to_bytes,patterns,[minimize]*len(patterns),chunksize=chunksize))
+
+    # Rebuild the dfa's from the bytes
+    compiled = []
+    for pattern, (data, error) in zip(patterns,results):
+        dfa = DFA.from_bytes(data,copy=False) if data is not None else None
+        compiled.append((pattern,dfa,error))
+    return compiled
+
 def main():
 
     # Read the input
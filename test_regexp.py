@@ -0,0 +1,118 @@
+# Regression checks for the parser, run with pytest
+
+from regexp import RegexpParser
+
+def test_repeated_term_memo():
+    # The memo of a repeated term must be kept under the source text of the term
+    for parser in (RegexpParser(), RegexpParser(minimize=True)):
+        dfa = parser.parse('a^2|2')
+        assert dfa.check_string('2')
+        assert dfa.check_string('aa')
+        assert not dfa.check_string('a')
+    nfa = RegexpParser().parse('a^2|2',nfa=True)
+    assert nfa.check_string('2')
+    assert nfa.check_string('aa')
+
+def test_digify_partial_dfa():
+    # The missing edges of a partial dfa lead to the implicit sink
+    from dfa import digify_DFA
+    for pattern, lengths in (('aaa',['3']), ('a^[2-4]',['2','3','4'])):
+        dfa = digify_DFA(RegexpParser().parse(pattern))
+        assert list(dfa.enumerate()) == lengths
+
+def test_check_strings_trailing_nul():
+    # Characters outside the alphabet are rejected, even a trailing '\x00'
+    dfa = RegexpParser().parse('(a|b)*abb')
+    assert list(dfa.check_strings(['abb\x00','abb','\x00abb'])) == [False,True,False]
+
+def test_truncated_cache_entry(tmp_path):
+    # A truncated dfa is refused, and the cache treats its file as a miss
+    from dfa import DFA
+    from regexp import CompileCache
+    data = RegexpParser().parse('(a|b)*abb').to_bytes()
+    for cut in (1,4,8):
+        try:
+            DFA.from_bytes(data[:-cut])
+        except Exception:
+            continue
+        assert False, "loaded a dfa missing "+str(cut)+" bytes"
+    cache = CompileCache(directory=str(tmp_path))
+    with open(cache.path_for('key'),'wb') as f:
+        f.write(data[:-8])
+    assert cache.get('key') is None
+
+def test_unknown_characters_rejected():
+    # A character outside the alphabet is rejected however the language is stored
+    from dfa import DFA, lazy_combine_DFA
+    dfa = RegexpParser().parse('(a|b)*abb')
+    loose = DFA(dfa.alphabet)
+    loose.set_state_target(0,dfa.start_state in dfa.target_states)
+    for s in range(1,dfa.num_states):
+        loose.add_state(s in dfa.target_states)
+    for s in range(dfa.num_states):
+        for char, se in dfa.edges[s].items():
+            loose.add_edge((s-dfa.start_state)%dfa.num_states,(se-dfa.start_state)%dfa.num_states,char)
+    assert loose.table is None
+    lazy = lazy_combine_DFA(dfa,RegexpParser().parse('(a|b)*'),'&')
+    for checker in (dfa, loose, lazy):
+        assert not checker.check_string('abbz')
+        assert not checker.check_string('zabb')
+        assert checker.check_string('abb')
+    assert not dfa.compile_to_python()('abbz')
+    assert list(dfa.check_strings(['abbz'])) == [False]
+
+def test_save_load_round_trip(tmp_path):
+    # A saved dfa loads back with and without mmap, and accepts the same strings
+    from dfa import DFA, FORMAT_VERSION
+    import itertools
+    dfa = RegexpParser().parse('(a|b)*abb&~((a|b)*aaa(a|b)*)')
+    path = str(tmp_path/'saved.dfa')
+    dfa.save(path)
+    strings = [''.join(s) for n in range(7) for s in itertools.product('ab',repeat=n)]
+    mapped = DFA.load(path,mmap=True)
+    copied = DFA.load(path,mmap=False)
+    for loaded in (mapped, copied):
+        assert loaded.num_states == dfa.num_states
+        assert loaded.target_states == dfa.target_states
+        assert [loaded.check_string(s) for s in strings] == [dfa.check_string(s) for s in strings]
+    assert mapped.frozen
+    try:
+        mapped.add_state()
+    except Exception:
+        pass
+    else:
+        assert False, "altered a dfa mapped from a file"
+    assert not copied.frozen
+
+    # The version is the byte after the magic
+    data = bytearray(dfa.to_bytes())
+    data[5] = FORMAT_VERSION+1
+    try:
+        DFA.from_bytes(bytes(data))
+    except Exception as e:
+        assert "version" in str(e)
+    else:
+        assert False, "loaded a dfa of another format version"
+
+def test_lazy_dfa_eviction():
+    # With only a few states kept, the lazy dfa is flushed and falls back to the nfa all the
+    # time, and it must still agree with the nfa
+    import random
+    nfa = RegexpParser().parse('(a|b)*a(a|b)^12',nfa=True)
+    rng = random.Random(0)
+    strings = [''.join(rng.choice('ab') for i in range(rng.randint(0,80))) for j in range(200)]
+    strings += ['a'+'b'*12, 'b'*200+'a'+'ab'*6, 'ab'*150]
+    expected = [nfa.check_string(s) for s in strings]
+    for max_states in (2, 3, 5):
+        lazy = nfa.lazy_dfa(max_states)
+        assert [lazy.check_string(s) for s in strings] == expected
+        assert lazy.stats()['flushes'] > 0
+
+        # Two matchers are fed in turns, so one is flushed while the other is halfway
+        for s, t, es, et in zip(strings[0::2],strings[1::2],expected[0::2],expected[1::2]):
+            first, second = lazy.matcher(), lazy.matcher()
+            for at in range(0,max(len(s),len(t)),3):
+                first.feed(s[at:at+3])
+                second.feed(t[at:at+3])
+            assert first.accepted() == es
+            assert second.accepted() == et